@@ -0,0 +1,300 @@
+"""Throughput benchmarks of the grid pipeline on synthetic L4 products.
+
+Generates daily L4 files in the layout of each product (CMEMS monthly
+subdirectories, SWOT/MIOST, BLUELINK yt_ocean/xt_ocean) with a land mask, NaN
+gaps and an equatorward coastal trapped wave, then times the extraction, filtering
+and reconstruction stages of create_filtered_time_series.py and
+create_filtered_grids.py on them. No access to the /DGFI8 data is needed.
+
+Example:
+    python benchmark_pipeline.py --cases CMEMS BLUELINK --sizes 64x64 128x128 --days 60 120 \
+        --output benchmark.json
+    python benchmark_pipeline.py --baseline benchmark.json  # Fails if a stage got slower
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import create_filtered_time_series as step4
+import create_filtered_grids as step5
+from ctw_functions import FileCatalog, extract_region_cube, fill_nan_from_nearest, butter_bandpass_filter_bands
+from ctw_functions import region_mask, scatter_series_to_cube, place_series_in_grid, save_grid_cube, open_region_lazy
+
+### Synthetic L4 products
+
+# Grid spacing in degrees of each product
+PRODUCT_RESOLUTION = {'CMEMS': 0.125, 'SWOT': 0.1, 'BLUELINK': 0.1}
+
+def synthetic_grid(case, n_lat, n_lon):
+    """Latitudes and longitudes of an n_lat x n_lon grid over the east Australian coast."""
+    resolution = PRODUCT_RESOLUTION[case]
+    latitudes = -32 + resolution * (np.arange(n_lat) - n_lat / 2)
+    longitudes = 153 + resolution * (np.arange(n_lon) - n_lon / 3)
+    return latitudes, longitudes
+
+def synthetic_land_mask(latitudes, longitudes, seed=0):
+    """Land west of a wiggly coastline, plus a few small islands offshore."""
+    rng = np.random.default_rng(seed)
+    lon_grid, lat_grid = np.meshgrid(longitudes, latitudes)
+    coast = 153 + 0.6 * np.sin(np.radians(lat_grid) * 40) + 0.2 * np.sin(np.radians(lat_grid) * 170)
+    land = lon_grid < coast
+    for island_lat, island_lon in zip(rng.uniform(latitudes.min(), latitudes.max(), 3),
+                                      rng.uniform(153.5, max(longitudes.max(), 153.6), 3)):
+        land |= np.hypot(lat_grid - island_lat, lon_grid - island_lon) < 0.15
+    return land
+
+def synthetic_sla_fields(latitudes, longitudes, land, n_days, seed=0, gap_probability=0.2):
+    """Yield one daily SLA field (m) after the other.
+
+    The signal is a coastal trapped wave (amplitude decaying offshore over ~100 km,
+    10-day period, ~3 m/s equatorward phase speed) on top of slowly drifting
+    mesoscale eddies and white noise. With probability `gap_probability` a day
+    gets a random 4 x 4 cell NaN gap, as in gappy products.
+    """
+    rng = np.random.default_rng(seed)
+    lon_grid, lat_grid = np.meshgrid(longitudes, latitudes)
+    distance_km = np.clip(lon_grid - 153, 0, None) * 111.2 * np.cos(np.radians(lat_grid))
+    along_km = lat_grid * 111.2
+    eddy_k = rng.uniform(0.02, 0.06, (4, 2))  # Wavenumbers in rad/km
+    eddy_phase = rng.uniform(0, 2 * np.pi, 4)
+
+    for day in range(n_days):
+        ctw = 0.05 * np.exp(-distance_km / 100) * np.cos(2 * np.pi * day / 10 - 2 * np.pi * along_km / 2600)
+        eddies = sum(0.1 * np.sin(k_lat * along_km + k_lon * distance_km - 0.05 * day + phase)
+                     for (k_lat, k_lon), phase in zip(eddy_k, eddy_phase)) / 4
+        sla = ctw + eddies + 0.005 * rng.standard_normal(land.shape)
+        sla[land] = np.nan
+        if rng.random() < gap_probability:
+            i, j = rng.integers(0, max(len(latitudes) - 4, 1)), rng.integers(0, max(len(longitudes) - 4, 1))
+            sla[i:i + 4, j:j + 4] = np.nan
+        yield sla
+
+def write_synthetic_product(base_dir, case, n_lat, n_lon, n_days, start_date='2023-08-29', seed=0):
+    """Write n_days daily L4 files of a product in its directory layout and file naming.
+
+    CMEMS files go to monthly subdirectories with int16 sla (scale_factor 1e-4,
+    as distributed), SWOT/MIOST files to `base_dir` with float32 sla, both as
+    sla(time, latitude, longitude). BLUELINK files are written as by
+    model_data_reader.ipynb: sla(yt_ocean, xt_ocean) with latitude/longitude
+    coordinates and a separate length-1 time.
+
+    Returns:
+        numpy.ndarray: vertices (lon, lat) of a region covering the coast and the shelf.
+    """
+    latitudes, longitudes = synthetic_grid(case, n_lat, n_lon)
+    land = synthetic_land_mask(latitudes, longitudes, seed=seed)
+    days = pd.date_range(start_date, periods=n_days, freq='D')
+
+    for day, sla in zip(days, synthetic_sla_fields(latitudes, longitudes, land, n_days, seed=seed)):
+        day_str = day.strftime('%Y%m%d')
+        if case == 'CMEMS':
+            directory = os.path.join(base_dir, day.strftime('%m'))
+            file_name = f"dt_global_allsat_phy_l4_{day_str}_20240301.nc"
+            encoding = {'sla': {'dtype': 'int16', 'scale_factor': 1e-4, '_FillValue': np.int16(-32768)}}
+        elif case == 'SWOT':
+            directory = base_dir
+            file_name = f"NRT_L4_SWOT_MIOST_sla_{day_str}_20240301.nc"
+            encoding = {'sla': {'dtype': 'float32'}}
+        else:
+            directory = base_dir
+            file_name = f"dt_global_allsat_phy_l4_{day_str}.nc"
+            encoding = {'sla': {'dtype': 'float32'}}
+        os.makedirs(directory, exist_ok=True)
+
+        if case == 'BLUELINK':
+            dataset = xr.Dataset(
+                {'sla': (['yt_ocean', 'xt_ocean'], sla)},
+                coords={'yt_ocean': latitudes, 'xt_ocean': longitudes, 'latitude': ('yt_ocean', latitudes),
+                        'longitude': ('xt_ocean', longitudes), 'time': [day]}
+            )
+        else:
+            dataset = xr.Dataset(
+                {'sla': (['time', 'latitude', 'longitude'], sla[None])},
+                coords={'time': [day], 'latitude': latitudes, 'longitude': longitudes}
+            )
+        dataset.to_netcdf(os.path.join(directory, file_name), encoding=encoding)
+
+    # Region: from the coast to the outer third of the grid, leaving a halo on each side
+    margin = 6 * PRODUCT_RESOLUTION[case]
+    lat_min, lat_max = latitudes.min() + margin, latitudes.max() - margin
+    lon_min, lon_max = 152.0, longitudes.max() - margin
+    return np.array([[lon_min, lat_min], [lon_max, lat_min], [lon_max, lat_max], [lon_min, lat_max]])
+
+### Benchmarks
+
+def timed(function, *args, repeat=1, **kwargs):
+    """Run function `repeat` times and return (result, best elapsed seconds)."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def configure_step4(vertices):
+    """Point the region of create_filtered_time_series.py to the synthetic product."""
+    step4.parallelogram_vertices = vertices
+    step4.region = {'polygon': vertices}
+
+def benchmark_product(work_dir, case, n_lat, n_lon, n_days, bands=((0.035, 0.15, 5),), fs=1.0,
+                      point_sample=16, max_workers=None, lazy=True, repeat=3):
+    """Time every stage of the pipeline on one synthetic product.
+
+    Returns:
+        list of dict: one row per stage with the elapsed seconds and the
+        throughput in grid cell-days per second (points/s for the point extraction).
+        The in-memory stages, which take milliseconds, report the best of `repeat` runs.
+    """
+    bands = [tuple(band) for band in bands]
+    base_dir = os.path.join(work_dir, f"{case}_{n_lat}x{n_lon}_{n_days}d")
+    shutil.rmtree(base_dir, ignore_errors=True)
+    vertices, generate_time = timed(write_synthetic_product, os.path.join(base_dir, 'L4'), case, n_lat, n_lon, n_days)
+    configure_step4(vertices)
+
+    rows = []
+    def record(stage, seconds, work, unit='cell_days'):
+        rows.append({'case': case, 'grid': f"{n_lat}x{n_lon}", 'days': n_days, 'stage': stage,
+                     'seconds': seconds, 'throughput': work / seconds if seconds > 0 else np.inf, 'unit': unit})
+        print(f"{case} {n_lat}x{n_lon} {n_days}d {stage:<20} {seconds:8.3f} s {rows[-1]['throughput']:14.1f} {unit}/s")
+
+    record('generate', generate_time, n_lat * n_lon * n_days)
+
+    # File lookup, from scratch and from the saved catalog
+    catalog_file = os.path.join(base_dir, 'catalog.json')
+    date_file_list, seconds = timed(lambda: FileCatalog(os.path.join(base_dir, 'L4'), case, catalog_file=catalog_file).files())
+    record('catalog_build', seconds, n_days, unit='files')
+    date_file_list, seconds = timed(lambda: FileCatalog(os.path.join(base_dir, 'L4'), case, catalog_file=catalog_file).files())
+    record('catalog_reuse', seconds, n_days, unit='files')
+
+    # Extraction
+    (times, latitudes, longitudes, cube), seconds = timed(extract_region_cube, date_file_list, vertices, case)
+    cell_days = cube.size
+    record('extract_cube', seconds, cell_days)
+
+    if lazy:
+        try:
+            import dask
+            sla, seconds = timed(lambda: open_region_lazy(date_file_list, vertices, case, space_chunk=32).compute())
+            record('extract_lazy', seconds, cell_days)
+        except ImportError:
+            print("dask is not available, skipping the lazy extraction")
+
+    mask = region_mask(latitudes, longitudes, step4.region, np.isnan(cube[0]), case)
+    lat_indices, lon_indices = np.nonzero(mask)
+    n_points = len(lat_indices)
+
+    # Legacy per-point extraction, on a sample of points (it opens every file for every point).
+    # Its NaN fallback find_nearest_non_nan only knows the latitude/longitude dimensions
+    if case != 'BLUELINK' and point_sample > 0:
+        point_dir = os.path.join(base_dir, 'points')
+        os.makedirs(point_dir, exist_ok=True)
+        sample = np.linspace(0, n_points - 1, min(point_sample, n_points)).astype(int)
+        _, seconds = timed(lambda: [step4.process_grid_point(latitudes[lat_indices[k]], longitudes[lon_indices[k]],
+                                                             date_file_list, bands[0][0], bands[0][1], fs,
+                                                             point_dir, case, order=bands[0][2])
+                                    for k in sample])
+        record('extract_point', seconds, len(sample), unit='points')
+
+    # Filtering
+    filled, seconds = timed(fill_nan_from_nearest, cube, f"benchmark_{case}", repeat=repeat)
+    record('fill_nearest', seconds, cell_days)
+    series = filled[:, lat_indices, lon_indices]
+    (filtered, nan_fraction), seconds = timed(butter_bandpass_filter_bands, series, bands, fs, repeat=repeat)
+    record('filter', seconds, series.size * len(bands))
+
+    # Reconstruction, from per-point series (per-point file input) and from the (time, point) matrix (store or memory)
+    grid_lat, grid_lon = latitudes[mask.any(axis=1)], longitudes[mask.any(axis=0)]
+    time_range = pd.date_range(times[0], times[-1], freq='D')
+    point_lat, point_lon = latitudes[lat_indices], longitudes[lon_indices]
+    point_args = ([times.values] * n_points, point_lat, point_lon, list(filtered[0].T))
+    grid, seconds = timed(scatter_series_to_cube, time_range, grid_lat, grid_lon, *point_args, repeat=repeat)
+    record('reconstruct_scatter', seconds, grid.size)
+    grid, seconds = timed(place_series_in_grid, time_range, grid_lat, grid_lon, times, point_lat, point_lon, filtered[0],
+                           repeat=repeat)
+    record('reconstruct_place', seconds, grid.size)
+    _, seconds = timed(save_grid_cube, os.path.join(base_dir, 'grids.nc'), time_range, grid_lat, grid_lon, grid)
+    record('save_grids', seconds, grid.size)
+
+    # End to end: store then reconstruction, and the fused pipeline
+    for output in ['store', 'grids']:
+        output_dir = os.path.join(base_dir, output)
+        os.makedirs(output_dir, exist_ok=True)
+        _, seconds = timed(step4.extract_and_filter_cube, date_file_list, case, output_dir, bands, fs, output=output,
+                           max_workers=max_workers)
+        record(f"step4_{output}", seconds, cell_days)
+    _, seconds = timed(step5.reconstruct_daily_grids, os.path.join(base_dir, 'store'), date_file_list[0][1],
+                       os.path.join(base_dir, 'reconstructed'), times[0], times[-1], vertices, resume=False,
+                       output_layout='single')
+    record('step5_single', seconds, grid.size)
+
+    return rows
+
+def compare_to_baseline(rows, baseline_rows, tolerance=0.2):
+    """Return the stages whose throughput dropped by more than `tolerance` against a baseline run."""
+    key = lambda row: (row['case'], row['grid'], row['days'], row['stage'])
+    baseline = {key(row): row for row in baseline_rows}
+    regressions = []
+    for row in rows:
+        reference = baseline.get(key(row))
+        if reference is not None and row['stage'] != 'generate' and \
+                row['throughput'] < (1 - tolerance) * reference['throughput']:
+            regressions.append((key(row), reference['throughput'], row['throughput']))
+    return regressions
+
+# Main function to run the benchmark suite
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmarks of the grid pipeline on synthetic L4 products.")
+    parser.add_argument('--cases', nargs='+', default=['CMEMS', 'SWOT', 'BLUELINK'], choices=list(PRODUCT_RESOLUTION))
+    parser.add_argument('--sizes', nargs='+', default=['64x64'], help="grid sizes as n_latxn_lon")
+    parser.add_argument('--days', nargs='+', type=int, default=[60])
+    parser.add_argument('--point-sample', type=int, default=16, help="points timed in the per-point extraction")
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--no-lazy', action='store_true', help="skip the dask extraction")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of the in-memory stages, the best is kept")
+    parser.add_argument('--work-dir', default=None, help="directory of the synthetic files, a temporary one by default")
+    parser.add_argument('--output', default=None, help="JSON file for the results")
+    parser.add_argument('--baseline', default=None, help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative throughput drop")
+    args = parser.parse_args()
+
+    # filtfilt pads the series with 3 * (2 * order + 1) samples and needs longer series
+    if min(args.days) <= 33:
+        parser.error("--days must be larger than 33 for the order-5 band-pass filter")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='ctw_benchmark_')
+    rows = []
+    try:
+        for case in args.cases:
+            for size in args.sizes:
+                n_lat, n_lon = (int(n) for n in size.lower().split('x'))
+                for n_days in args.days:
+                    rows += benchmark_product(work_dir, case, n_lat, n_lon, n_days, point_sample=args.point_sample,
+                                              max_workers=args.max_workers, lazy=not args.no_lazy,
+                                              repeat=args.repeat)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=1)
+        print(f"Saved benchmark results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(rows, json.load(f), tolerance=args.tolerance)
+        for (case, grid, days, stage), reference, current in regressions:
+            print(f"REGRESSION {case} {grid} {days}d {stage}: {current:.1f}/s against {reference:.1f}/s")
+        if regressions:
+            sys.exit(1)
+        print("No throughput regression against the baseline.")
+
+if __name__ == '__main__':
+    main()
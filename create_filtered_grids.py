@@ -4,49 +4,50 @@ import numpy as np
 import pandas as pd
 from datetime import datetime
 import time
-from concurrent.futures import ProcessPoolExecutor
-from scipy.signal import butter, filtfilt
+import functools
 
-from ctw_functions import butter_bandpass, butter_bandpass_filter, interpolate_nan, find_nearest_non_nan
-
-# Function to check if a point is inside the parallelogram
-def is_inside_parallelogram(lat, lon, vertices):
-    """
-    Check if a point (lat, lon) is inside the defined parallelogram
-    """
-    if lon < np.min(vertices[:, 0]) or lon > np.max(vertices[:, 0]):
-        return False
-    if lat < np.min(vertices[:, 1]) or lat > np.max(vertices[:, 1]):
-        return False
-    return True
-
-
-# Function to check if a point is within a certain tolerance of another point
-def is_close(a, b, tol=0.01):
-    """Check if two floating-point numbers are within a certain tolerance."""
-    return abs(a - b) < tol
+from ctw_functions import open_series_store, RunManifest, file_list_signature, FileCatalog
+from ctw_functions import scatter_series_to_cube, place_series_in_grid, save_grid_cube, BackgroundWriter, region_mask, grid_indices
+from ctw_functions import sla_encoding
+from pipeline_functions import run_key, stage_timer, write_netcdf, reset_metrics, write_metrics_summary, profiled
 
 # Function to reconstruct daily grids from filtered time series
-def reconstruct_daily_grids(input_dir, original_grid_file, output_dir, start_date, end_date, parallelogram_vertices, test_days=5):
+def reconstruct_daily_grids(input_dir, original_grid_file, output_dir, start_date, end_date, parallelogram_vertices, test_days=5, resume=True, band=0,
+                            output_layout='daily', output_format='netcdf', n_writers=2, write_queue=8, region=None,
+                            encoding='float64', compression='zlib'):
+    """Reconstruct gridded filtered SLA from the filtered time series.
+
+    output_layout='daily' writes one filtered_grid_YYYYMMDD.nc per day;
+    output_layout='single' writes the whole period as one time-chunked,
+    compressed filtered_grids_YYYYMMDD_YYYYMMDD.nc (or .zarr with
+    output_format='zarr'). Daily files are written by `n_writers` background
+    processes, with at most `write_queue` days waiting to be written.
+
+    Only the cells of `region` (see region_mask in ctw_functions.py; by default
+    the parallelogram) are reconstructed, the others are NaN. `encoding` and
+    `compression` set the on-disk type of `sla` (see sla_encoding). The stage
+    timings of the run are saved to metrics_reconstruction_<timestamp>.json/.csv
+    in `output_dir`.
+    """
     # Start a timer to measure performance
     start_time = time.time()
+    reset_metrics()
 
     # Load the original grid to get the spatial structure (lat/lon dimensions)
     original_dataset = xr.open_dataset(original_grid_file)
     latitudes = original_dataset.latitude.values
     longitudes = original_dataset.longitude.values
 
-    # Filter latitudes and longitudes based on the parallelogram
-    lat_indices, lon_indices = [], []
-    for lat_idx, lat in enumerate(latitudes):
-        for lon_idx, lon in enumerate(longitudes):
-            if is_inside_parallelogram(lat, lon, parallelogram_vertices):
-                lat_indices.append(lat_idx)
-                lon_indices.append(lon_idx)
+    # Reduce latitudes and longitudes to the region of interest (bounding box of the parallelogram)
+    valid_latitudes = latitudes[(latitudes >= np.min(parallelogram_vertices[:, 1])) & (latitudes <= np.max(parallelogram_vertices[:, 1]))]
+    valid_longitudes = longitudes[(longitudes >= np.min(parallelogram_vertices[:, 0])) & (longitudes <= np.max(parallelogram_vertices[:, 0]))]
 
-    # Reduce latitudes and longitudes to the region of interest
-    valid_latitudes = latitudes[np.unique(lat_indices)]
-    valid_longitudes = longitudes[np.unique(lon_indices)]
+    # Cells of the region within the bounding box; land is where the original grid is NaN
+    if region is None:
+        region = {'polygon': parallelogram_vertices}
+    land_mask = np.isnan(original_dataset['sla'].squeeze(drop=True).values)
+    land_mask = land_mask[np.isin(latitudes, valid_latitudes)][:, np.isin(longitudes, valid_longitudes)]
+    mask = region_mask(valid_latitudes, valid_longitudes, region, land_mask, 'original_grid')
 
     # Create a time range for the target dates
     time_range = pd.date_range(start=start_date, end=end_date, freq='D')
@@ -55,55 +56,112 @@ def reconstruct_daily_grids(input_dir, original_grid_file, output_dir, start_dat
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
-    # Initialize a dictionary to store all the time series data
-    time_series_data = {}
+    # Consolidated (time, point) store written by create_filtered_time_series.py, if any
+    store_path = os.path.join(input_dir, 'filtered_sla_store.nc')
+    if not os.path.isdir(input_dir) or input_dir.rstrip('/').endswith('.zarr'):
+        store_path = input_dir  # input_dir is the store itself
+
+    # Files read by the reconstruction: the store (every file of a zarr store) or the per-point files
+    if os.path.isdir(store_path):
+        input_files = sorted(os.path.join(root, file_name) for root, dirs, files in os.walk(store_path)
+                             for file_name in files)
+    elif os.path.exists(store_path):
+        input_files = [store_path]
+    else:
+        input_files = sorted(os.path.join(input_dir, file_name) for file_name in os.listdir(input_dir)
+                             if file_name.startswith('filtered_sla_lat_') and file_name.endswith('.nc'))
+
+    # Name of the output file of the single-file layout
+    single_file = f"filtered_grids_{time_range[0].strftime('%Y%m%d')}_{time_range[-1].strftime('%Y%m%d')}"
+    single_file += '.zarr' if output_format == 'zarr' else '.nc'
+
+    # Record the days already written, so that a rerun on unchanged inputs skips them
+    if resume:
+        run_params = {
+            'input': input_dir, 'original_grid_file': original_grid_file, 'start_date': start_date,
+            'end_date': end_date, 'vertices': np.asarray(parallelogram_vertices).tolist(), 'band': band,
+            'output_layout': output_layout, 'output_format': output_format, 'encoding': encoding,
+            'compression': compression,
+            'region': {name: np.asarray(value).tolist() for name, value in region.items()},
+        }
+        # Keyed on the input files themselves: rewriting them in place does not change the directory mtime
+        key = run_key(inputs=file_list_signature(input_files + [original_grid_file]), **run_params)
+        manifest = RunManifest(os.path.join(output_dir, 'run_manifest.txt'), key, params=run_params)
+        if output_layout == 'single':
+            time_range = [] if manifest.is_done(single_file) else list(time_range)
+        else:
+            time_range = [day for day in time_range if not manifest.is_done(day.strftime('%Y%m%d'))]
+        if not time_range:
+            print("All daily grids are already reconstructed.")
+            original_dataset.close()
+            return
+
+    if os.path.exists(store_path):
+        # Load all time series from the consolidated (time, point) store
+        ds = open_series_store(store_path)
+        with stage_timer('read_store') as counts:
+            filtered_sla = ds['filtered_sla']
+            if 'band' in filtered_sla.dims:
+                filtered_sla = filtered_sla.isel(band=band)  # Multi-band store: reconstruct one band
+            filtered_sla = filtered_sla.transpose('time', 'point').values
+            counts['items'], counts['bytes'] = filtered_sla.shape[1], filtered_sla.nbytes
+
+        # The points share the time axis of the store: place the (time, point) matrix directly,
+        # looking up the grid cell once per point and the day once per time step
+        time_range = pd.DatetimeIndex(time_range)
+        with stage_timer('scatter', items=filtered_sla.size):
+            cube = place_series_in_grid(time_range, valid_latitudes, valid_longitudes, ds['time'].values,
+                                        ds['latitude'].values, ds['longitude'].values, filtered_sla)
+        ds.close()
 
     # Load all time series files (assuming format filtered_sla_lat_xx_lon_xx.nc) from input directory
-    for file_name in os.listdir(input_dir):
-        if file_name.startswith('filtered_sla') and file_name.endswith('.nc'):
+    else:
+        point_lat, point_lon, point_times, point_series = [], [], [], []
+        for file_path in input_files:
+            file_name = os.path.basename(file_path)
             lat_lon_str = file_name.replace('filtered_sla_lat_', '').replace('.nc', '')
             lat_str, lon_str = lat_lon_str.split('_lon_')
             lat, lon = round(float(lat_str), 2), round(float(lon_str), 2)  # Round to two decimal places
 
-            # Load the time series for this grid point
-            ds = xr.open_dataset(os.path.join(input_dir, file_name))
-            time_series_data[(lat, lon)] = ds['filtered_sla'].values
-            ds.close()
-
-    # For each day in the range, reconstruct the grid and save as NetCDF
-    for day in time_range:
+            # Skip the grid points outside the region
+            lat_idx, lon_idx = grid_indices(valid_latitudes, [lat])[0], grid_indices(valid_longitudes, [lon])[0]
+            if lat_idx < 0 or lon_idx < 0 or not mask[lat_idx, lon_idx]:
+                continue
+
+            # Load the time series for this grid point, with its own time axis
+            with stage_timer('read_point_file', items=1), xr.open_dataset(file_path) as ds:
+                filtered_sla = ds['filtered_sla']
+                if 'band' in filtered_sla.dims:
+                    filtered_sla = filtered_sla.isel(band=band)
+                point_series.append(filtered_sla.values)
+                point_times.append(ds['time'].values)
+            point_lat.append(lat)
+            point_lon.append(lon)
+
+        # Reconstruct all days at once: map every series to its (lat_idx, lon_idx) and every
+        # time step to its day, then scatter them into a (time, lat, lon) cube
+        time_range = pd.DatetimeIndex(time_range)
+        with stage_timer('scatter', items=sum(len(series) for series in point_series)):
+            cube = scatter_series_to_cube(time_range, valid_latitudes, valid_longitudes,
+                                          point_times, point_lat, point_lon, point_series)
+    cube[:, ~mask] = np.nan
+
+    # Save the whole period as one time-chunked file
+    if output_layout == 'single':
+        output_file = os.path.join(output_dir, single_file)
+        save_grid_cube(output_file, time_range, valid_latitudes, valid_longitudes, cube,
+                       encoding=encoding, compression=compression)
+        if resume:
+            manifest.mark_done(single_file)
+        print(f"Saved reconstructed grids from {time_range[0]} to {time_range[-1]} to {output_file}")
+        time_range = []
+
+    # Otherwise, for each day in the range, save the reconstructed grid as NetCDF.
+    # The files are written in the background; a day is marked done once its file is written
+    writer = BackgroundWriter(n_writers=n_writers, max_queue=write_queue, use_processes=True)
+    for day_idx, day in enumerate(time_range):
         print(f"Reconstructing grid for {day}")
-
-        # Initialize an empty array for the grid (valid lat, valid lon)
-        grid = np.full((len(valid_latitudes), len(valid_longitudes)), np.nan)
-
-        # Iterate over each valid grid point and assign the value for the current day
-        for lat_idx, lat in enumerate(valid_latitudes):
-            for lon_idx, lon in enumerate(valid_longitudes):
-                found = False
-
-                # Check against each time series data point
-                for (ts_lat, ts_lon), values in time_series_data.items():
-                    if is_close(lat, ts_lat) and is_close(lon, ts_lon):
-                        # Find the corresponding value for the current day
-                        try:
-                            # Extract the time array once
-                            time_values = ds['time'].values
-
-                            # Make sure the current day is in the time series
-                            day_index = np.where(time_values == np.datetime64(day))[0]
-                            
-                            if day_index.size > 0:
-                                grid[lat_idx, lon_idx] = values[day_index[0]]
-                                found = True
-                                break  # Exit loop after finding the correct data
-
-                        except Exception as e:
-                            print(f"Error accessing data for ({lat}, {lon}) on {day}: {e}")
-
-#                 if not found:
-#                     # Only print if the point truly has no corresponding time series data
-#                     print(f"Missing time series for ({lat}, {lon})")
+        grid = cube[day_idx]
 
         # Create a new dataset for the current day
         filtered_dataset = xr.Dataset(
@@ -119,8 +177,11 @@ def reconstruct_daily_grids(input_dir, original_grid_file, output_dir, start_dat
 
         # Save the reconstructed grid for this day
         output_file = os.path.join(output_dir, f"filtered_grid_{day.strftime('%Y%m%d')}.nc")
-        filtered_dataset.to_netcdf(output_file)
-        print(f"Saved reconstructed grid for {day} to {output_file}")
+        on_done = functools.partial(manifest.mark_done, day.strftime('%Y%m%d')) if resume else None
+        writer.submit(write_netcdf, filtered_dataset, output_file, stage='write_grid', on_done=on_done,
+                      encoding={'sla': sla_encoding(encoding, compression)})
+        print(f"Queued reconstructed grid for {day} to {output_file}")
+    writer.close()
 
     original_dataset.close()
 
@@ -128,6 +189,8 @@ def reconstruct_daily_grids(input_dir, original_grid_file, output_dir, start_dat
     end_time = time.time()
     total_time = end_time - start_time
     print(f"Total processing time for reconstruction: {total_time:.2f} seconds")
+    write_metrics_summary(os.path.join(output_dir, f"metrics_reconstruction_{datetime.now().strftime('%Y%m%d_%H%M%S')}"),
+                          wall_seconds=total_time)
 
 
 
@@ -136,14 +199,14 @@ def main():
     input_dir = '/nfs/DGFI8/H/work_marcello/coastal_trapped_waves_data/filtered_grids_SWOT'
     output_dir = '/nfs/DGFI8/H/work_marcello/coastal_trapped_waves_data/filtered_daily_grids_SWOT_reconstructed'
     
-    # Dynamically select any original grid file from the specified directory
+    # Dynamically select any original grid file from the specified directory (via its file catalog)
     original_grid_dir = '/DGFI8/D/SWOT_L4/SWOT_Daily_Product_L4'
-    original_grid_files = [f for f in os.listdir(original_grid_dir) if f.endswith('.nc')]
+    original_grid_files = FileCatalog(original_grid_dir, 'SWOT').files()
     
     if not original_grid_files:
         raise FileNotFoundError("No original grid files found in the specified directory.")
 
-    original_grid_file = os.path.join(original_grid_dir, original_grid_files[0])  # Use the first file found
+    original_grid_file = original_grid_files[0][1]  # Use the first file found
     print(f"Using original grid file: {original_grid_file}")
 
     start_date = datetime(2023, 8, 29)
@@ -157,8 +220,12 @@ def main():
         [149, -25]   # Top-left
     ])
 
-    # Run reconstruction with a limit on the number of days to process
-    reconstruct_daily_grids(input_dir, original_grid_file, output_dir, start_date, end_date, parallelogram_vertices, test_days=5)
+    # Run reconstruction with a limit on the number of days to process (profiled if CTW_PROFILE_DIR is set)
+    with profiled('create_filtered_grids'):
+        reconstruct_daily_grids(input_dir, original_grid_file, output_dir, start_date, end_date, parallelogram_vertices,
+                                test_days=5,
+                                output_layout='daily',  # read by the analysis notebooks; 'single' for one time-chunked file
+                                encoding='float32', compression='zlib')  # or 'int16_mm' (mm precision), 'zstd'
 
 if __name__ == "__main__":
     main()
@@ -4,10 +4,15 @@ from datetime import datetime
 import xarray as xr
 import numpy as np
 import pandas as pd
-from concurrent.futures import ProcessPoolExecutor
-from scipy.signal import butter, filtfilt
 
-from ctw_functions import butter_bandpass, butter_bandpass_filter, interpolate_nan, find_nearest_non_nan
+from ctw_functions import butter_bandpass_filter, interpolate_nan, find_nearest_non_nan
+from ctw_functions import fill_nan_from_nearest, extract_region_cube_cached, butter_bandpass_filter_bands, save_series_store
+from ctw_functions import RunManifest, file_list_signature, band_coords, FileCatalog
+from ctw_functions import open_region_lazy, fill_and_filter_lazy, region_mask
+from ctw_functions import region_slices, place_series_in_grid, save_grid_cube, sla_encoding
+from ctw_functions import product_dims, make_tiles, BackgroundWriter
+from pipeline_functions import run_key, stage_timer, write_netcdf, reset_metrics, write_metrics_summary, profiled
+from pipeline_functions import share_array, attach_shared_array, run_tiles
 
 # Define the vertices of the parallelogram for EAST_AUSTRALIA
 parallelogram_vertices = np.array([
@@ -17,20 +22,32 @@ parallelogram_vertices = np.array([
     [149, -25]   # Top-left
 ])
 
-# Check if a point is inside the parallelogram
-def is_inside_parallelogram(lat_grid, lon_grid, vertices):
-    # Mask for points inside the bounding box (min/max lat/lon)
-    mask_lon = (lon_grid >= vertices[:, 0].min()) & (lon_grid <= vertices[:, 0].max())
-    mask_lat = (lat_grid >= vertices[:, 1].min()) & (lat_grid <= vertices[:, 1].max())
-    return mask_lon & mask_lat
+# Outputs written by each extraction mode
+extraction_outputs = {
+    'cube': ('points', 'store', 'grids'),
+    'point': ('points',),
+    'lazy': ('store',),
+}
+
+# Region of the processed grid points: the parallelogram, optionally restricted to a coastal band
+# ('coast_distance_km') or an isobath band ('depth_range' in m, read from 'bathymetry_file').
+# The mask is rasterized once per product grid, see region_mask in ctw_functions.py
+region = {
+    'polygon': parallelogram_vertices,
+    'coast_distance_km': None,  # e.g. 150 to keep only the coastal waveguide
+    'depth_range': None,  # e.g. (0, 2000)
+    'bathymetry_file': None,  # e.g. a GEBCO NetCDF file, with variable 'elevation'
+}
 
 # Function to process each valid point and save to NetCDF in parallel
-def process_grid_point(latitude, longitude, date_file_list, lowcut, highcut, fs, output_dir, case):
+def process_grid_point(latitude, longitude, date_file_list, lowcut, highcut, fs, output_dir, case, writer=None,
+                       encoding='float64', compression=None, order=5):
     sla_data = []
     date_list = []
 
     for file_date, file_path in date_file_list:
-        dataset = xr.open_dataset(file_path)
+        with stage_timer('open_file'):
+            dataset = xr.open_dataset(file_path)
         
         # Check if we are processing Bluelink, adjust the latitude/longitude dimensions accordingly
         if case == 'BLUELINK':
@@ -42,12 +59,13 @@ def process_grid_point(latitude, longitude, date_file_list, lowcut, highcut, fs,
             lon_coord = dataset.longitude
             sla_var = 'sla'
 
-        # Find nearest indices to the specified latitude and longitude
-        lat_idx = abs(lat_coord - latitude).argmin()
-        lon_idx = abs(lon_coord - longitude).argmin()
+        with stage_timer('read_point', items=1):
+            # Find nearest indices to the specified latitude and longitude
+            lat_idx = abs(lat_coord - latitude).argmin()
+            lon_idx = abs(lon_coord - longitude).argmin()
 
-        # Extract SLA at the specified point
-        sla_data_point = dataset[sla_var].isel({lat_coord.dims[0]: lat_idx, lon_coord.dims[0]: lon_idx}).values.item()
+            # Extract SLA at the specified point
+            sla_data_point = dataset[sla_var].isel({lat_coord.dims[0]: lat_idx, lon_coord.dims[0]: lon_idx}).values.item()
 
         # Only proceed if the SLA point is non-NaN
         if not np.isnan(sla_data_point):
@@ -55,13 +73,20 @@ def process_grid_point(latitude, longitude, date_file_list, lowcut, highcut, fs,
             date_list.append(file_date)
         else:
             # Attempt to find a nearby non-NaN value
-            sla_data_point = find_nearest_non_nan(dataset, lat_idx, lon_idx)
+            with stage_timer('nan_search', items=1):
+                sla_data_point = find_nearest_non_nan(dataset, lat_idx, lon_idx)
             if not np.isnan(sla_data_point):
                 sla_data.append(sla_data_point)
                 date_list.append(file_date)
 
         dataset.close()
 
+    return filter_and_save_series(latitude, longitude, date_list, sla_data, lowcut, highcut, fs, output_dir, writer,
+                                  encoding, compression, order=order)
+
+# Filter the collected series of one grid point and save it to NetCDF
+def filter_and_save_series(latitude, longitude, date_list, sla_data, lowcut, highcut, fs, output_dir, writer=None,
+                           encoding='float64', compression=None, order=5):
     if not sla_data:  # If no valid data collected, return NaN-filled arrays
         return latitude, longitude, np.nan, np.nan
 
@@ -73,40 +98,286 @@ def process_grid_point(latitude, longitude, date_file_list, lowcut, highcut, fs,
     series = sla_time_series_da.values
     nan_count = np.isnan(series).sum()
 
-    if nan_count <= 0.9 * len(sla_time_series_da.time):
-        if nan_count > 0:
-            series = interpolate_nan(series)  # Interpolate NaNs
-        filtered_series = butter_bandpass_filter(series, lowcut, highcut, fs, order=5)
-    else:
-        filtered_series = np.full_like(series, np.nan)  # Create NaN-filled array
+    with stage_timer('filter', items=len(series)):
+        if nan_count <= 0.9 * len(sla_time_series_da.time):
+            if nan_count > 0:
+                series = interpolate_nan(series)  # Interpolate NaNs
+            filtered_series = butter_bandpass_filter(series, lowcut, highcut, fs, order=order)
+        else:
+            filtered_series = np.full_like(series, np.nan)  # Create NaN-filled array
 
     # Save results to NetCDF
-    save_to_netcdf(latitude, longitude, sla_time_series_da, filtered_series, output_dir)
+    save_to_netcdf(latitude, longitude, sla_time_series_da, filtered_series, output_dir, writer=writer,
+                   encoding=encoding, compression=compression)
 
     return latitude, longitude, series, filtered_series
 
-def save_to_netcdf(lat, lon, unfiltered_series, filtered_series, output_dir):
-    """Save the unfiltered and filtered series to NetCDF format."""
-    file_name = f"filtered_sla_lat_{lat:.2f}_lon_{lon:.2f}.nc"
-    output_path = os.path.join(output_dir, file_name)
+def point_file_name(lat, lon):
+    """Name of the NetCDF file holding the series of one grid point."""
+    return f"filtered_sla_lat_{lat:.2f}_lon_{lon:.2f}.nc"
+
+def save_to_netcdf(lat, lon, unfiltered_series, filtered_series, output_dir, bands=None, writer=None,
+                   encoding='float64', compression=None):
+    """Save the unfiltered and filtered series to NetCDF format.
+
+    For a multi-band run `filtered_series` is (band, time) and `bands` holds the
+    (lowcut, highcut, order) of each band. With a BackgroundWriter the file is
+    written in the background and the caller must flush the writer. `encoding`
+    and `compression` set the on-disk type of the series (see sla_encoding).
+    """
+    output_path = os.path.join(output_dir, point_file_name(lat, lon))
+
+    if bands is not None:
+        filtered_da = xr.DataArray(filtered_series, dims=["band", "time"],
+                                   coords={"time": unfiltered_series.time, **band_coords(bands)})
+    else:
+        filtered_da = xr.DataArray(filtered_series, dims=["time"], coords={"time": unfiltered_series.time})
 
     # Create a dataset with unfiltered and filtered SLA data
     ds = xr.Dataset(
         {
             "unfiltered_sla": xr.DataArray(unfiltered_series.values, dims=["time"], coords={"time": unfiltered_series.time}),
-            "filtered_sla": xr.DataArray(filtered_series, dims=["time"], coords={"time": unfiltered_series.time})
+            "filtered_sla": filtered_da
         },
         coords={"latitude": lat, "longitude": lon}
     )
 
     # Save to NetCDF format
-    ds.to_netcdf(output_path)
+    var_encoding = {v: sla_encoding(encoding, compression) for v in ['unfiltered_sla', 'filtered_sla']}
+    if writer is not None:
+        writer.submit(write_netcdf, ds, output_path, stage='write_point', encoding=var_encoding)
+    else:
+        write_netcdf(ds, output_path, stage='write_point', encoding=var_encoding)
     #print(f"Saved {output_path}")
 
+# State of a tile worker process, set once per process by init_tile_worker
+_tile_state = {}
+
+def init_tile_worker(state):
+    """Receive the run parameters once per worker and attach the shared arrays."""
+    _tile_state.update(state)
+    for name in ['series', 'filtered']:
+        if name in state:
+            _tile_state[name + '_shm'], _tile_state[name] = attach_shared_array(state[name])
+    # Per-point files are written by a background thread while the next points are processed
+    if state['output'] == 'points':
+        _tile_state['writer'] = BackgroundWriter(n_writers=1, max_queue=state.get('write_queue', 16))
+
+# Filter the grid points of one tile, from the shared (time, points) matrix
+def filter_tile(tile):
+    state = _tile_state
+    points = tile['points']
+    with stage_timer('filter', items=state['series'].shape[0] * len(points) * len(state['bands'])):
+        filtered, nan_fraction = butter_bandpass_filter_bands(state['series'][:, points], state['bands'], state['fs'])
+
+    # Store and grid output: write into the shared (band, time, points) result, saved by the main process
+    if state['output'] in ('store', 'grids'):
+        state['filtered'][:, :, points] = filtered
+        return tile['key']
+
+    # Otherwise save one NetCDF file per grid point
+    output_bands = state['bands'] if len(state['bands']) > 1 else None
+    for k, point in enumerate(points):
+        unfiltered_series = xr.DataArray(state['series'][:, point], dims=['time'], coords={'time': state['times']})
+        filtered_series = filtered[:, :, k] if output_bands else filtered[0, :, k]
+        save_to_netcdf(state['latitudes'][point], state['longitudes'][point], unfiltered_series,
+                       filtered_series, state['output_dir'], output_bands, writer=state['writer'],
+                       encoding=state['encoding'], compression=state['compression'])
+
+    # A tile is only reported done once all its files are written
+    state['writer'].flush()
+    return tile['key']
+
+# Process the grid points of one tile by reading the daily files (point extraction mode)
+def process_point_tile(tile):
+    state = _tile_state
+    for point in tile['points']:
+        process_grid_point(state['latitudes'][point], state['longitudes'][point], state['date_file_list'],
+                           state['lowcut'], state['highcut'], state['fs'], state['output_dir'], state['case'],
+                           writer=state['writer'], encoding=state['encoding'], compression=state['compression'],
+                           order=state['order'])
+    state['writer'].flush()
+    return tile['key']
+
+# Cube mode: open each daily file once, then filter all valid grid points tile by tile with every
+# (lowcut, highcut, order) band of `bands`
+def extract_and_filter_cube(date_file_list, case, output_dir, bands, fs, output='store', manifest=None, cache_dir=None,
+                            tile_size=16, max_workers=None, encoding='float64', compression='zlib'):
+    if manifest is not None and manifest.is_done('complete'):
+        return
+
+    # The raw cube is cached on disk, so changing the bands does not re-read the files
+    times, latitudes, longitudes, cube = extract_region_cube_cached(date_file_list, parallelogram_vertices, case,
+                                                                    cache_dir=cache_dir)
+
+    # Valid grid points: inside the region and non-NaN on the first day
+    mask = region_mask(latitudes, longitudes, region, np.isnan(cube[0]), case, cache_dir=cache_dir)
+    lat_indices, lon_indices = np.nonzero(mask)
+    if lat_indices.size == 0:
+        return
+
+    # Replace NaNs by the nearest valid cell of the same day, as in process_grid_point.
+    # Days still NaN after this are interpolated by the batched filter
+    series = fill_nan_from_nearest(cube, case, cache_dir=cache_dir)[:, lat_indices, lon_indices]
+
+    # Per-point output can resume tile by tile; the store and the grids are written once at the end
+    tiles = make_tiles(lat_indices, lon_indices, tile_size)
+    if output == 'points' and manifest is not None:
+        tiles = [tile for tile in tiles if not manifest.is_done(tile['key'])]
+
+    # Workers read the series from, and write the store output to, shared memory.
+    # All bands are applied to the same data in one pass
+    series_shm, series_ref = share_array(series)
+    filtered_shm, filtered_ref = share_array(np.full((len(bands),) + series.shape, np.nan))
+    state = {
+        'series': series_ref, 'filtered': filtered_ref, 'times': times, 'bands': bands, 'fs': fs,
+        'latitudes': latitudes[lat_indices], 'longitudes': longitudes[lon_indices],
+        'output': output, 'output_dir': output_dir, 'encoding': encoding, 'compression': compression,
+    }
+    on_result = (lambda tile, key: manifest.mark_done(key)) if output == 'points' and manifest is not None else None
+
+    try:
+        run_tiles(filter_tile, tiles, initializer=init_tile_worker, initargs=(state,),
+                  max_workers=max_workers, on_result=on_result)
+
+        # Save all points to one consolidated (time, point) store; a single band keeps
+        # the (time, point) layout, several bands add a leading band dimension
+        if output == 'store':
+            filtered = np.ndarray((len(bands),) + series.shape, dtype=float, buffer=filtered_shm.buf)
+            if len(bands) == 1:
+                filtered, output_bands = filtered[0], None
+            else:
+                output_bands = bands
+            save_series_store(os.path.join(output_dir, 'filtered_sla_store.nc'), times,
+                              latitudes[lat_indices], longitudes[lon_indices], series, filtered, bands=output_bands,
+                              encoding=encoding, compression=compression)
+            del filtered
+
+        # Fused pipeline: place the filtered series directly into daily grids, without writing them first
+        if output == 'grids':
+            filtered = np.ndarray((len(bands),) + series.shape, dtype=float, buffer=filtered_shm.buf)
+            save_filtered_grids(output_dir, times, latitudes, longitudes, lat_indices, lon_indices, filtered,
+                                encoding=encoding, compression=compression)
+            del filtered
+    finally:
+        for shm in [series_shm, filtered_shm]:
+            shm.close()
+            shm.unlink()
+
+    if manifest is not None:
+        manifest.mark_done('complete')
+
+# Point mode: read every daily file once per grid point, tile by tile, and filter it with a single band
+def extract_and_filter_points(date_file_list, case, output_dir, bands, fs, manifest=None, cache_dir=None, tile_size=16,
+                              max_workers=None, encoding='float64', compression=None):
+    if len(bands) != 1:
+        raise ValueError("Point extraction filters a single band, use cube extraction for several bands")
+    (lowcut, highcut, order), = bands
+
+    # Open a sample dataset to get lat/lon values
+    lat_dim, lon_dim = product_dims(case)
+    with xr.open_dataset(date_file_list[0][1]) as sample_dataset:
+        latitudes = sample_dataset[lat_dim].values
+        longitudes = sample_dataset[lon_dim].values
+        sample_sla = sample_dataset['sla'].transpose(..., lat_dim, lon_dim).values.reshape(len(latitudes), len(longitudes))
+
+    # Valid grid points: inside the region and non-NaN in the first sample dataset
+    mask = region_mask(latitudes, longitudes, region, np.isnan(sample_sla), case, cache_dir=cache_dir)
+    lat_indices, lon_indices = np.nonzero(mask)
+
+    # Process the points tile by tile; date_file_list is sent once per worker, not once per point
+    tiles = make_tiles(lat_indices, lon_indices, tile_size)
+    if manifest is not None:
+        tiles = [tile for tile in tiles if not manifest.is_done(tile['key'])]
+    state = {
+        'date_file_list': date_file_list, 'latitudes': latitudes[lat_indices], 'longitudes': longitudes[lon_indices],
+        'output': 'points', 'lowcut': lowcut, 'highcut': highcut, 'order': order, 'fs': fs, 'output_dir': output_dir, 'case': case,
+        'encoding': encoding, 'compression': compression,
+    }
+    on_result = (lambda tile, key: manifest.mark_done(key)) if manifest is not None else None
+    run_tiles(process_point_tile, tiles, initializer=init_tile_worker, initargs=(state,),
+              max_workers=max_workers, on_result=on_result)
+
+# Save the filtered (band, time, point) series as time-chunked grids over the bounding box of the region,
+# as create_filtered_grids.py does with output_layout='single'
+def save_filtered_grids(output_dir, times, latitudes, longitudes, lat_indices, lon_indices, filtered,
+                        encoding='float64', compression='zlib'):
+    lat_slice, lon_slice = region_slices(latitudes, longitudes, parallelogram_vertices)
+    time_range = pd.date_range(pd.Timestamp(times[0]), pd.Timestamp(times[-1]), freq='D')
+    period = f"{time_range[0].strftime('%Y%m%d')}_{time_range[-1].strftime('%Y%m%d')}"
+
+    # One file per band; a single band keeps the file name of the reconstruction
+    n_bands = filtered.shape[0]
+    for band_idx in range(n_bands):
+        grid = place_series_in_grid(time_range, latitudes[lat_slice], longitudes[lon_slice], times,
+                                    latitudes[lat_indices], longitudes[lon_indices], filtered[band_idx])
+        band_name = f"band{band_idx}_" if n_bands > 1 else ''
+        output_file = os.path.join(output_dir, f"filtered_grids_{band_name}{period}.nc")
+        save_grid_cube(output_file, time_range, latitudes[lat_slice], longitudes[lon_slice], grid,
+                       encoding=encoding, compression=compression)
+        print(f"Saved filtered grids from {time_range[0]} to {time_range[-1]} to {output_file}")
+
+# Lazy mode: open all daily files with open_mfdataset and filter chunk by chunk, streaming to the store
+def extract_and_filter_lazy(date_file_list, case, output_dir, bands, fs, manifest=None, cache_dir=None, space_chunk=64,
+                            encoding='float64', compression='zlib'):
+    if manifest is not None and manifest.is_done('complete'):
+        return
+
+    sla = open_region_lazy(date_file_list, parallelogram_vertices, case, space_chunk=space_chunk)
+
+    # Valid grid points: inside the region and non-NaN on the first day (only that day is read here)
+    mask = region_mask(sla['latitude'].values, sla['longitude'].values, region, np.isnan(sla.isel(time=0).values), case,
+                       cache_dir=cache_dir)
+    lat_indices, lon_indices = np.nonzero(mask)
+    if lat_indices.size == 0:
+        return
+
+    filled, filtered = fill_and_filter_lazy(sla, bands, fs, case, cache_dir=cache_dir)
+
+    # Select the valid points as a (time, point) layout, still lazily
+    point_index = {'latitude': xr.DataArray(lat_indices, dims='point'), 'longitude': xr.DataArray(lon_indices, dims='point')}
+    unfiltered_points = filled.isel(point_index).data
+    filtered_points = filtered.isel(point_index).data
+    if len(bands) == 1:
+        filtered_points, output_bands = filtered_points[0], None
+    else:
+        output_bands = bands
+
+    # Writing the store computes the graph chunk by chunk
+    save_series_store(os.path.join(output_dir, 'filtered_sla_store.nc'), sla['time'].values,
+                      sla['latitude'].values[lat_indices], sla['longitude'].values[lon_indices],
+                      unfiltered_points, filtered_points, bands=output_bands, encoding=encoding,
+                      compression=compression)
+    sla.close()
+
+    if manifest is not None:
+        manifest.mark_done('complete')
+
 # Main processing function
 def main():
-    
+    # Define the frequency cutoffs for the filter
+    lowcut = 0.035  # Lower cutoff in cycles per day
+    highcut = 0.15  # Upper cutoff in cycles per day
+    # (lowcut, highcut, order) of each band; with cube extraction several bands are applied in one pass
+    bands = [(lowcut, highcut, 5)]
+    fs = 1.0  # Sampling frequency in cycles per day
+
     case = 'CMEMS'  # Choose SWOT, CMEMS, or BLUELINK
+    extraction = 'cube'  # 'cube' reads each daily file once for the whole region, 'point' reads it once per grid point,
+                         # 'lazy' streams the region through dask chunks for domains that do not fit in memory
+    output = 'points'  # 'points' writes one file per grid point (read by the analysis notebooks), 'store' one
+                       # consolidated (time, point) file, 'grids' directly the filtered grids of step 5
+                       # (see extraction_outputs for the outputs of each extraction)
+    cache_dir = '/nfs/DGFI8/H/work_marcello/coastal_trapped_waves_data/cube_cache'  # Raw cube (cube extraction only), region mask and nearest-cell index cache, None to disable
+    tile_size = 16  # Grid cells per side of the spatial tiles processed by each task
+    space_chunk = 64  # Grid cells per side of the dask chunks (lazy extraction only), at least the NaN search radius (5)
+    max_workers = None  # Number of worker processes, None for all CPUs
+    encoding = 'float32'  # On-disk type of the SLA outputs: 'float64', 'float32' or 'int16_mm' (see SLA_ENCODINGS)
+    compression = 'zlib'  # 'zlib', 'zstd' or None
+
+    if output not in extraction_outputs.get(extraction, ()):
+        raise ValueError(f"Extraction '{extraction}' cannot write output '{output}', "
+                         f"supported outputs: {extraction_outputs.get(extraction, ())}")
     
     # CASE SWOT
     if case == 'SWOT':    
@@ -125,93 +396,44 @@ def main():
 
     os.makedirs(output_dir, exist_ok=True)  # Ensure output directory exists
 
-    # Collect all NetCDF file paths and dates
-    date_file_list = []
+    # Collect all NetCDF file paths and dates from the persistent catalog of the product directory
     start_date = datetime(2023, 8, 29)
     end_date = datetime(2023, 11, 30)
-
-    if case == 'CMEMS':
-        # Iterate through each month subdirectory "01" to "12"
-        for month in range(1, 13):
-            month_str = f"{month:02d}"  # Format month as "01", "02", ..., "12"
-            month_dir = os.path.join(base_dir, month_str)
-            if os.path.exists(month_dir):
-                for file_name in os.listdir(month_dir):
-                    if file_name.endswith('.nc'):
-                        file_date_str = file_name.split('_')[-2]
-                        file_date = datetime.strptime(file_date_str, "%Y%m%d")
-                        if start_date <= file_date <= end_date:
-                            file_path = os.path.join(month_dir, file_name)
-                            date_file_list.append((file_date, file_path))
-
-    elif case == 'SWOT':
-        # For SWOT, just check the base directory
-        for file_name in os.listdir(base_dir):
-            if file_name.endswith('.nc'):
-                file_date_str = file_name.split('_')[-2]
-                file_date = datetime.strptime(file_date_str, "%Y%m%d")
-                if start_date <= file_date <= end_date:
-                    file_path = os.path.join(base_dir, file_name)
-                    date_file_list.append((file_date, file_path))
-    
-    elif case == 'BLUELINK':
-        # For BLUELINK, file naming is dt_global_allsat_phy_l4_YYYYMMDD.nc
-        for file_name in os.listdir(base_dir):
-            if file_name.endswith('.nc'):
-                file_date_str = file_name.split('_')[-1].replace('.nc', '')  # Extract date part
-                file_date = datetime.strptime(file_date_str, "%Y%m%d")
-                if start_date <= file_date <= end_date:
-                    file_path = os.path.join(base_dir, file_name)
-                    date_file_list.append((file_date, file_path))
-
-    date_file_list.sort()
-
-    # Use a ProcessPoolExecutor to parallelize processing for each valid grid point
-    with ProcessPoolExecutor() as executor:
-        futures = []
-        # Open a sample dataset to get lat/lon values
-        sample_file_path = date_file_list[0][1] if date_file_list else None
-        if sample_file_path:
-            sample_dataset = xr.open_dataset(sample_file_path)
-            
-            if case == 'BLUELINK':
-                latitudes = sample_dataset.yt_ocean.values
-                longitudes = sample_dataset.xt_ocean.values
-            else:
-                latitudes = sample_dataset.latitude.values
-                longitudes = sample_dataset.longitude.values
-
-            # Create 2D grids of lat/lon using meshgrid
-            lat_grid, lon_grid = np.meshgrid(latitudes, longitudes)
-
-            # Get the mask for valid grid points within the parallelogram
-            mask = is_inside_parallelogram(lat_grid, lon_grid, parallelogram_vertices)
-            valid_lats = lat_grid[mask]
-            valid_lons = lon_grid[mask]
-
-            for latitude, longitude in zip(valid_lats, valid_lons):
-                # Check if the SLA data point is non-NaN in the first sample dataset
-                lat_idx = abs(latitudes - latitude).argmin()
-                lon_idx = abs(longitudes - longitude).argmin()
-                if case == 'BLUELINK':
-                    sla_data_point = sample_dataset['sla'].isel(yt_ocean=lat_idx, xt_ocean=lon_idx).values.item()
-                else:
-                    sla_data_point = sample_dataset['sla'].isel(latitude=lat_idx, longitude=lon_idx).values.item()
-                
-                if not np.isnan(sla_data_point):
-                    futures.append(executor.submit(process_grid_point, latitude, longitude, date_file_list, lowcut, highcut, fs, output_dir, case))
-
-            # Retrieve results and print summary for the first few points
-            for future in futures:
-                latitude, longitude, unfiltered, filtered = future.result()
-                #print(f"Processed point at lat: {latitude}, lon: {longitude}")
+    date_file_list = FileCatalog(base_dir, case).files(start_date, end_date)
+
+    if not date_file_list:
+        return
+
+    # Record finished work, so that a rerun with the same parameters and inputs skips it
+    run_params = {
+        'case': case, 'start_date': start_date, 'end_date': end_date,
+        'bands': bands, 'fs': fs, 'extraction': extraction, 'output': output,
+        'vertices': parallelogram_vertices.tolist(), 'tile_size': tile_size, 'encoding': encoding,
+        'compression': compression,
+        'region': {name: np.asarray(value).tolist() for name, value in region.items()},
+    }
+    key = run_key(inputs=file_list_signature([file_path for file_date, file_path in date_file_list]), **run_params)
+    manifest = RunManifest(os.path.join(output_dir, 'run_manifest.txt'), key, params=run_params)
+
+    # Stage timers and counters of this run, summed over the worker processes
+    reset_metrics()
+    run_start = time.time()
+    with profiled('create_filtered_time_series'):
+        if extraction == 'lazy':
+            extract_and_filter_lazy(date_file_list, case, output_dir, bands, fs, manifest=manifest,
+                                    cache_dir=cache_dir, space_chunk=space_chunk, encoding=encoding, compression=compression)
+        elif extraction == 'cube':
+            extract_and_filter_cube(date_file_list, case, output_dir, bands, fs, output=output, manifest=manifest,
+                                    cache_dir=cache_dir, tile_size=tile_size, max_workers=max_workers,
+                                    encoding=encoding, compression=compression)
+        else:
+            extract_and_filter_points(date_file_list, case, output_dir, bands, fs, manifest=manifest,
+                                      cache_dir=cache_dir, tile_size=tile_size, max_workers=max_workers,
+                                      encoding=encoding, compression=compression)
+    write_metrics_summary(os.path.join(output_dir, f"metrics_{datetime.now().strftime('%Y%m%d_%H%M%S')}"),
+                          wall_seconds=time.time() - run_start, params=run_params)
 
 if __name__ == '__main__':
-    # Define the frequency cutoffs for the filter
-    lowcut = 0.035  # Lower cutoff in cycles per day
-    highcut = 0.15  # Upper cutoff in cycles per day
-    fs = 1.0  # Sampling frequency in cycles per day
-
     # Start a timer to measure performance
     start_time = time.time()
     main()  # Call the main processing function
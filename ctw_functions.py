@@ -2,8 +2,22 @@
 # coding: utf-8
 
 # In[ ]:
+import os
+import json
+import functools
+import atexit
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy import ndimage
 from scipy.signal import butter, filtfilt
 import numpy as np
+import pandas as pd
+import xarray as xr
+from pipeline_functions import run_key, points_in_polygon, stage_timer, merge_metrics, call_with_metrics, write_netcdf
+from pipeline_functions import save_cache_entry
 
 # Define the Butterworth bandpass filter
 def butter_bandpass(lowcut, highcut, fs, order=5):
@@ -24,6 +38,88 @@ def interpolate_nan(data):
     data[nans] = np.interp(x(nans), x(~nans), data[~nans])
     return data
 
+def interpolate_nan_columns(data):
+    """Interpolate NaNs along the time axis of every column of a (time, points) matrix.
+
+    Same result as applying `interpolate_nan` to each column (linear in between,
+    constant beyond the first/last valid value), computed without a Python loop.
+    Columns without any valid value stay NaN.
+    """
+    data = np.array(data, dtype=float)
+    n_time = data.shape[0]
+    valid = ~np.isnan(data)
+    idx = np.broadcast_to(np.arange(n_time)[:, None], data.shape)
+
+    # Index of the previous and of the next valid value for every entry
+    prev_idx = np.maximum.accumulate(np.where(valid, idx, -1), axis=0)
+    next_idx = np.minimum.accumulate(np.where(valid, idx, n_time)[::-1], axis=0)[::-1]
+    prev_idx = np.where(prev_idx < 0, next_idx, prev_idx)
+    next_idx = np.where(next_idx >= n_time, prev_idx, next_idx)
+    prev_idx = np.clip(prev_idx, 0, n_time - 1)
+    next_idx = np.clip(next_idx, 0, n_time - 1)
+
+    columns = np.arange(data.shape[1])
+    prev_val = data[prev_idx, columns]
+    next_val = data[next_idx, columns]
+    span = next_idx - prev_idx
+    weight = np.divide(idx - prev_idx, span, out=np.zeros(data.shape), where=span > 0)
+
+    data[~valid] = (prev_val + weight * (next_val - prev_val))[~valid]
+    return data
+
+def butter_bandpass_filter_bands(data, bands, fs, nan_threshold=0.9):
+    """Band-pass filter every column of a (time, points) matrix with several bands.
+
+    NaN gaps are interpolated once per column, and the filter coefficients are
+    designed once per band and applied to all columns in one `filtfilt` call.
+    Columns with a NaN fraction above `nan_threshold` are returned as NaN, as in
+    the per-point processing.
+
+    Args:
+        data (numpy.ndarray): (time, points) SLA matrix.
+        bands (list): (lowcut, highcut, order) of each band.
+        fs (float): sampling frequency.
+        nan_threshold (float, optional): maximum NaN fraction. Defaults to 0.9.
+
+    Returns:
+        filtered (numpy.ndarray): (band, time, points) filtered matrices.
+        nan_fraction (numpy.ndarray): fraction of NaNs in each column.
+    """
+    data = np.asarray(data, dtype=float)
+    nan_fraction = np.isnan(data).mean(axis=0)
+    valid = nan_fraction <= nan_threshold
+
+    filtered = np.full((len(bands),) + data.shape, np.nan)
+    if valid.any():
+        filled = interpolate_nan_columns(data[:, valid])
+        for band, (lowcut, highcut, order) in enumerate(bands):
+            b, a = butter_bandpass(lowcut, highcut, fs, order=order)
+            filtered[band][:, valid] = filtfilt(b, a, filled, axis=0)
+    return filtered, nan_fraction
+
+def butter_bandpass_filter_matrix(data, lowcut, highcut, fs, order=5, nan_threshold=0.9):
+    """Band-pass filter every column of a (time, points) matrix in one call.
+
+    Single band version of `butter_bandpass_filter_bands`.
+
+    Returns:
+        filtered (numpy.ndarray): filtered matrix, same shape as `data`.
+        nan_fraction (numpy.ndarray): fraction of NaNs in each column.
+    """
+    filtered, nan_fraction = butter_bandpass_filter_bands(data, [(lowcut, highcut, order)], fs,
+                                                          nan_threshold=nan_threshold)
+    return filtered[0], nan_fraction
+
+def band_coords(bands):
+    """Coordinates describing the `band` dimension of multi-band outputs."""
+    bands = np.asarray(bands, dtype=float)
+    return {
+        'band': np.arange(len(bands)),
+        'lowcut': ('band', bands[:, 0]),
+        'highcut': ('band', bands[:, 1]),
+        'order': ('band', bands[:, 2].astype(int)),
+    }
+
 def find_nearest_non_nan(dataset, lat_idx, lon_idx):
     """Find the nearest non-NaN value in the dataset around the given indices."""
     max_radius = 5  # Define the maximum search radius
@@ -39,3 +135,1019 @@ def find_nearest_non_nan(dataset, lat_idx, lon_idx):
                             return sla_data_point
     return np.nan
 
+### Nearest valid cell lookup
+
+# Neighbour indices last used in this process, keyed by product grid and mask. The lazy mode builds
+# one index per dask chunk, so only the NEAREST_VALID_CACHE_SIZE most recent ones are kept
+NEAREST_VALID_CACHE_SIZE = 8
+_nearest_valid_cache = OrderedDict()
+
+def build_nearest_valid_index(valid_mask, max_radius=5):
+    """For every cell of a 2D (lat, lon) mask, find the indices of the nearest valid cell.
+
+    Gives the cell `find_nearest_non_nan` finds (the first valid cell of the
+    smallest square ring, in its scan order), but runs the ring offsets once
+    over all the cells still missing a neighbour instead of once per cell and
+    day. Cells without a valid cell within `max_radius` grid cells get index -1.
+
+    Returns:
+        lat_idx, lon_idx (numpy.ndarray): index arrays with the shape of the mask.
+    """
+    n_lat, n_lon = valid_mask.shape
+    rows, cols = np.indices(valid_mask.shape)
+    lat_idx = np.where(valid_mask, rows, -1)
+    lon_idx = np.where(valid_mask, cols, -1)
+
+    pending_rows, pending_cols = np.nonzero(~valid_mask)
+    for radius in range(1, max_radius + 1):
+        for dlat in range(-radius, radius + 1):
+            for dlon in range(-radius, radius + 1):
+                if pending_rows.size == 0:
+                    return lat_idx, lon_idx
+                if abs(dlat) != radius and abs(dlon) != radius:
+                    continue
+                new_rows, new_cols = pending_rows + dlat, pending_cols + dlon
+                found = (new_rows >= 0) & (new_rows < n_lat) & (new_cols >= 0) & (new_cols < n_lon)
+                found[found] = valid_mask[new_rows[found], new_cols[found]]
+                lat_idx[pending_rows[found], pending_cols[found]] = new_rows[found]
+                lon_idx[pending_rows[found], pending_cols[found]] = new_cols[found]
+                pending_rows, pending_cols = pending_rows[~found], pending_cols[~found]
+    return lat_idx, lon_idx
+
+def get_nearest_valid_index(valid_mask, grid_key, max_radius=5, cache_dir=None):
+    """Return the nearest valid cell index of a mask, built once per product grid and mask.
+
+    Args:
+        valid_mask (numpy.ndarray): 2D boolean mask of the valid (ocean) cells.
+        grid_key (string): name of the product grid, e.g. 'CMEMS', 'SWOT' or 'BLUELINK'.
+        max_radius (int, optional): search radius in grid cells. Defaults to 5.
+        cache_dir (string, optional): directory where the index is also kept as
+            .npz, so that later runs on the same grid do not rebuild it.
+    """
+    mask_hash = hashlib.sha1(np.packbits(valid_mask)).hexdigest()[:16]
+    key = f"{grid_key}_{valid_mask.shape[0]}x{valid_mask.shape[1]}_r{max_radius}_{mask_hash}"
+    if key in _nearest_valid_cache:
+        _nearest_valid_cache.move_to_end(key)
+        return _nearest_valid_cache[key]
+
+    cache_file = os.path.join(cache_dir, f"nearest_valid_ring_{key}.npz") if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            index = cached['lat_idx'], cached['lon_idx']
+    else:
+        index = build_nearest_valid_index(valid_mask, max_radius=max_radius)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_file, lat_idx=index[0], lon_idx=index[1])
+
+    _nearest_valid_cache[key] = index
+    while len(_nearest_valid_cache) > NEAREST_VALID_CACHE_SIZE:
+        _nearest_valid_cache.popitem(last=False)
+    return index
+
+def fill_nan_from_nearest(cube, grid_key, max_radius=5, cache_dir=None):
+    """Replace the NaNs of a (time, lat, lon) cube by the nearest valid cell of the same day.
+
+    Days sharing the same NaN mask (usually all of them, as the mask is the
+    land mask) share one neighbour index, and each group is filled with a
+    single vectorized gather. Cells without a valid neighbour stay NaN.
+    """
+    valid = ~np.isnan(cube)
+    filled = cube.copy()
+
+    # Group the days by their NaN mask
+    days_by_mask = {}
+    for day_idx in range(cube.shape[0]):
+        days_by_mask.setdefault(np.packbits(valid[day_idx]).tobytes(), []).append(day_idx)
+
+    for days in days_by_mask.values():
+        with stage_timer('nan_search', items=valid[days[0]].size):
+            lat_idx, lon_idx = get_nearest_valid_index(valid[days[0]], grid_key, max_radius=max_radius,
+                                                       cache_dir=cache_dir)
+        with stage_timer('nan_fill', items=len(days) * valid[days[0]].size):
+            found = lat_idx >= 0
+            gathered = cube[days][:, np.clip(lat_idx, 0, None), np.clip(lon_idx, 0, None)]
+            gathered[:, ~found] = np.nan
+            filled[days] = np.where(valid[days], cube[days], gathered)
+    return filled
+
+### Regional cube extraction
+
+def product_dims(case):
+    """Return the (lat, lon) dimension names used by the daily files of a product."""
+    if case == 'BLUELINK':
+        return 'yt_ocean', 'xt_ocean'
+    return 'latitude', 'longitude'  # SWOT or CMEMS
+
+def region_slices(latitudes, longitudes, vertices, halo=0):
+    """Index slices covering the bounding box of the vertices, padded by `halo` cells."""
+    lat_idx = np.where((latitudes >= vertices[:, 1].min()) & (latitudes <= vertices[:, 1].max()))[0]
+    lon_idx = np.where((longitudes >= vertices[:, 0].min()) & (longitudes <= vertices[:, 0].max()))[0]
+    if lat_idx.size == 0 or lon_idx.size == 0:
+        raise ValueError("The region does not overlap the product grid.")
+    lat_slice = slice(max(lat_idx[0] - halo, 0), min(lat_idx[-1] + 1 + halo, len(latitudes)))
+    lon_slice = slice(max(lon_idx[0] - halo, 0), min(lon_idx[-1] + 1 + halo, len(longitudes)))
+    return lat_slice, lon_slice
+
+def extract_region_cube(date_file_list, vertices, case, halo=5):
+    """Read each daily file once and stack the regional SLA into a (time, lat, lon) cube.
+
+    The region is the bounding box of `vertices`, padded by `halo` cells so that
+    the nearest non-NaN search also works for points on the edge of the box.
+
+    Returns:
+        times (pandas.DatetimeIndex), latitudes, longitudes, cube (numpy.ndarray)
+    """
+    lat_dim, lon_dim = product_dims(case)
+
+    # Open the first file to get the grid and the subarray to slice out
+    with xr.open_dataset(date_file_list[0][1]) as sample_dataset:
+        latitudes = sample_dataset[lat_dim].values
+        longitudes = sample_dataset[lon_dim].values
+    lat_slice, lon_slice = region_slices(latitudes, longitudes, vertices, halo=halo)
+    latitudes = latitudes[lat_slice]
+    longitudes = longitudes[lon_slice]
+
+    cube = np.full((len(date_file_list), len(latitudes), len(longitudes)), np.nan)
+    for i, (file_date, file_path) in enumerate(date_file_list):
+        with stage_timer('open_file'):
+            dataset = xr.open_dataset(file_path)
+        with dataset, stage_timer('read_region', items=cube[i].size, nbytes=cube[i].nbytes):
+            sla = dataset['sla'].isel({lat_dim: lat_slice, lon_dim: lon_slice})
+            cube[i] = sla.transpose(..., lat_dim, lon_dim).values.reshape(cube.shape[1:])
+
+    times = pd.to_datetime([file_date for file_date, file_path in date_file_list])
+    return times, latitudes, longitudes, cube
+
+
+### Region masks
+
+_region_mask_cache = {}
+
+def polygon_mask(latitudes, longitudes, vertices):
+    """Boolean (lat, lon) mask of the grid cells inside a polygon.
+
+    Args:
+        vertices (array-like): (n, 2) polygon vertices as (lon, lat), like
+            parallelogram_vertices. Cells on the polygon edges are inside.
+    """
+    lon_grid, lat_grid = np.meshgrid(np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float))
+    return points_in_polygon(lat_grid, lon_grid, vertices)
+
+def coast_distance(latitudes, longitudes, land_mask):
+    """Distance in km of every grid cell to the nearest land cell of the grid.
+
+    The nearest land cell is found with a distance transform on the grid,
+    scaled by the cell size at the mean latitude, and the distance to it is
+    then computed along the great circle. Land cells have distance 0; a grid
+    without land returns inf everywhere. Land outside the grid is not seen, so
+    the grid should extend beyond the region (see the `halo` of the extraction).
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    if not land_mask.any():
+        return np.full(land_mask.shape, np.inf)
+
+    dlat = abs(np.median(np.diff(latitudes))) if len(latitudes) > 1 else 1.0
+    dlon = abs(np.median(np.diff(longitudes))) if len(longitudes) > 1 else 1.0
+    sampling = (dlat, dlon * np.cos(np.radians(latitudes.mean())))
+    lat_idx, lon_idx = ndimage.distance_transform_edt(~land_mask, sampling=sampling,
+                                                      return_distances=False, return_indices=True)
+
+    lat1, lon1 = np.radians(np.meshgrid(latitudes, longitudes, indexing='ij'))
+    lat2, lon2 = np.radians(latitudes[lat_idx]), np.radians(longitudes[lon_idx])
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def load_depth_on_grid(bathymetry_file, latitudes, longitudes, variable='elevation', positive='up'):
+    """Read a bathymetry grid (e.g. GEBCO) at the cells of a product grid, as depth in m (positive down).
+
+    Args:
+        variable (string, optional): name of the bathymetry variable. Defaults to 'elevation'.
+        positive (string, optional): 'up' if the variable is an elevation (negative
+            in the ocean, as in GEBCO), 'down' if it is already a depth.
+    """
+    with xr.open_dataset(bathymetry_file) as dataset:
+        bathymetry = dataset[variable]
+        lat_dim, lon_dim = bathymetry.dims[-2:]
+        values = bathymetry.sel({lat_dim: xr.DataArray(latitudes, dims='latitude'),
+                                 lon_dim: xr.DataArray(longitudes, dims='longitude')}, method='nearest').values
+    return -values if positive == 'up' else values
+
+def build_region_mask(latitudes, longitudes, region, land_mask):
+    """Rasterize a region definition on a product grid.
+
+    Args:
+        latitudes, longitudes (numpy.ndarray): 1D coordinates of the grid.
+        region (dict): region definition, with the optional keys
+            'polygon': (n, 2) vertices as (lon, lat);
+            'coast_distance_km': keep cells at most this far from the coast;
+            'depth_range': (min_depth, max_depth) in m, to keep an isobath band,
+            read from 'bathymetry_file' ('bathymetry_variable', 'bathymetry_positive'
+            as in `load_depth_on_grid`).
+        land_mask (numpy.ndarray): 2D boolean mask of the land (NaN) cells of the product.
+
+    Returns:
+        numpy.ndarray: 2D boolean mask of the ocean cells of the region.
+    """
+    mask = ~land_mask
+    if region.get('polygon') is not None:
+        mask &= polygon_mask(latitudes, longitudes, region['polygon'])
+    if region.get('coast_distance_km') is not None:
+        mask &= coast_distance(latitudes, longitudes, land_mask) <= region['coast_distance_km']
+    if region.get('depth_range') is not None:
+        depth = load_depth_on_grid(region['bathymetry_file'], latitudes, longitudes,
+                                   variable=region.get('bathymetry_variable', 'elevation'),
+                                   positive=region.get('bathymetry_positive', 'up'))
+        min_depth, max_depth = region['depth_range']
+        mask &= (depth >= min_depth) & (depth <= max_depth)
+    return mask
+
+def region_mask(latitudes, longitudes, region, land_mask, grid_key, cache_dir=None):
+    """Return the mask of a region on a product grid, rasterized once per grid, land mask and region.
+
+    Args:
+        grid_key (string): name of the product grid, e.g. 'CMEMS', 'SWOT' or 'BLUELINK'.
+        cache_dir (string, optional): directory where the mask is also kept as .npy,
+            so that later runs on the same grid do not rasterize it again.
+
+    See `build_region_mask` for the other arguments.
+    """
+    region = {name: np.asarray(value).tolist() if isinstance(value, np.ndarray) else value
+              for name, value in region.items()}
+    grid_hash = hashlib.sha1(np.asarray(latitudes, dtype=float).tobytes() + np.asarray(longitudes, dtype=float).tobytes()
+                             + np.packbits(land_mask).tobytes()).hexdigest()[:16]
+    key = f"{grid_key}_{land_mask.shape[0]}x{land_mask.shape[1]}_{grid_hash}_{run_key(**region)[:16]}"
+    if key in _region_mask_cache:
+        return _region_mask_cache[key]
+
+    cache_file = os.path.join(cache_dir, f"region_mask_{key}.npy") if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        mask = np.load(cache_file)
+    else:
+        mask = build_region_mask(latitudes, longitudes, region, land_mask)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_file, mask)
+
+    _region_mask_cache[key] = mask
+    return mask
+
+### Out-of-core processing
+
+def _select_region_sla(dataset, lat_dim, lon_dim, lat_slice, lon_slice):
+    """open_mfdataset preprocess: regional SLA as (time, latitude, longitude) for any product layout."""
+    sla = dataset['sla'].isel({lat_dim: lat_slice, lon_dim: lon_slice}).reset_coords(drop=True)
+    if 'time' not in sla.dims:
+        sla = sla.expand_dims(time=1)  # BLUELINK daily files have no time dimension on sla
+    if lat_dim != 'latitude':
+        sla = sla.rename({lat_dim: 'latitude', lon_dim: 'longitude'})
+    return sla.transpose('time', 'latitude', 'longitude').to_dataset(name='sla')
+
+def open_region_lazy(date_file_list, vertices, case, halo=5, space_chunk=64):
+    """Lazily open the regional SLA of all daily files as one dask-backed (time, lat, lon) DataArray.
+
+    Handles the CMEMS/SWOT `latitude/longitude` and BLUELINK `yt_ocean/xt_ocean`
+    layouts. The array is chunked with the full time axis and `space_chunk` x
+    `space_chunk` spatial tiles, so that every chunk can be filtered on its own.
+    """
+    lat_dim, lon_dim = product_dims(case)
+    with xr.open_dataset(date_file_list[0][1]) as sample_dataset:
+        latitudes = sample_dataset[lat_dim].values
+        longitudes = sample_dataset[lon_dim].values
+    lat_slice, lon_slice = region_slices(latitudes, longitudes, vertices, halo=halo)
+
+    preprocess = functools.partial(_select_region_sla, lat_dim=lat_dim, lon_dim=lon_dim,
+                                   lat_slice=lat_slice, lon_slice=lon_slice)
+    dataset = xr.open_mfdataset([file_path for file_date, file_path in date_file_list], preprocess=preprocess,
+                                combine='nested', concat_dim='time', data_vars='minimal', coords='minimal',
+                                compat='override')
+    sla = dataset['sla'].assign_coords(time=pd.to_datetime([file_date for file_date, file_path in date_file_list]))
+    return sla.chunk({'time': -1, 'latitude': space_chunk, 'longitude': space_chunk})
+
+def fill_and_filter_lazy(sla, bands, fs, grid_key, max_radius=5, nan_threshold=0.9, cache_dir=None):
+    """Fill NaNs from the nearest valid cell and band-pass filter a lazy cube chunk by chunk.
+
+    Nothing is computed here: the result is a dask graph that is evaluated one
+    spatial chunk at a time when written to disk, so memory stays bounded by the
+    chunk size whatever the domain size. `cache_dir` keeps the nearest-cell index
+    of every chunk on disk (see get_nearest_valid_index).
+
+    Returns:
+        filled (xarray.DataArray): (time, latitude, longitude) NaN-filled SLA.
+        filtered (xarray.DataArray): (band, time, latitude, longitude) filtered SLA.
+    """
+    # The neighbour search reaches max_radius cells into the adjacent chunks, so every chunk must be at least
+    # that wide (a short last chunk is merged with the previous one)
+    chunks = {}
+    for axis, dim in [(1, 'latitude'), (2, 'longitude')]:
+        sizes = list(sla.chunks[axis])
+        if len(sizes) > 1 and sizes[0] < max_radius:
+            raise ValueError(f"The {dim} chunks ({sizes[0]} cells) must be at least max_radius ({max_radius}) cells wide")
+        if len(sizes) > 1 and sizes[-1] < max_radius:
+            sizes[-2:] = [sizes[-2] + sizes[-1]]
+        chunks[dim] = tuple(sizes)
+    sla = sla.chunk(chunks)
+
+    filled_data = sla.data.map_overlap(fill_nan_from_nearest, depth={0: 0, 1: max_radius, 2: max_radius},
+                                       boundary='none', dtype=float, grid_key=grid_key, max_radius=max_radius,
+                                       cache_dir=cache_dir)
+
+    def filter_block(block):
+        n_time, n_lat, n_lon = block.shape
+        filtered, nan_fraction = butter_bandpass_filter_bands(block.reshape(n_time, -1), bands, fs,
+                                                              nan_threshold=nan_threshold)
+        return filtered.reshape(len(bands), n_time, n_lat, n_lon)
+
+    filtered_data = filled_data.map_blocks(filter_block, new_axis=0, chunks=((len(bands),),) + filled_data.chunks,
+                                           dtype=float)
+
+    filled = xr.DataArray(filled_data, dims=sla.dims, coords=sla.coords)
+    filtered = xr.DataArray(filtered_data, dims=('band',) + sla.dims, coords=sla.coords).assign_coords(band_coords(bands))
+    return filled, filtered
+
+### Raw cube cache
+
+def cube_cache_key(date_file_list, vertices, case, halo=5):
+    """Key of a raw SLA cube: product, region and date range (plus the file list)."""
+    return run_key(case=case, vertices=np.asarray(vertices).tolist(), halo=halo,
+                   start_date=date_file_list[0][0], end_date=date_file_list[-1][0],
+                   files=[file_path for file_date, file_path in date_file_list])
+
+def load_cached_cube(cache_dir, key):
+    """Load a cached raw SLA cube as a read-only memory map, or return None.
+
+    The memory map lets several worker processes read the same cube from the
+    page cache without each holding a copy.
+    """
+    cube_file = os.path.join(cache_dir, f"cube_{key}.npy")
+    coords_file = os.path.join(cache_dir, f"cube_{key}.coords.npz")
+    if not (os.path.exists(cube_file) and os.path.exists(coords_file)):
+        return None
+
+    os.utime(cube_file)  # Mark as recently used for the LRU eviction
+    with np.load(coords_file) as coords:
+        times = pd.to_datetime(coords['times'])
+        latitudes = coords['latitudes']
+        longitudes = coords['longitudes']
+    cube = np.load(cube_file, mmap_mode='r')
+    return times, latitudes, longitudes, cube
+
+def save_cached_cube(cache_dir, key, times, latitudes, longitudes, cube, max_bytes=20 * 1024**3):
+    """Store a raw SLA cube in the cache, then evict the least recently used cubes
+    until the cache is below `max_bytes`."""
+    # The cube is written last, so that load_cached_cube never finds it without its coordinates
+    savers = {
+        '.coords.npz': lambda path: np.savez(path, times=np.asarray(times, dtype='datetime64[ns]'),
+                                             latitudes=latitudes, longitudes=longitudes),
+        '.npy': lambda path: np.save(path, cube),
+    }
+    save_cache_entry(cache_dir, f"cube_{key}", savers, max_bytes, prefix='cube_')
+
+def extract_region_cube_cached(date_file_list, vertices, case, cache_dir=None, halo=5, max_bytes=20 * 1024**3):
+    """`extract_region_cube` with an on-disk cache of the raw (unfiltered) cube.
+
+    A rerun on the same product, region and date range (e.g. with another filter
+    band) reads the cube back as a memory map without opening any NetCDF file.
+    Without `cache_dir` this is the same as `extract_region_cube`.
+    """
+    if cache_dir is None:
+        return extract_region_cube(date_file_list, vertices, case, halo=halo)
+
+    key = cube_cache_key(date_file_list, vertices, case, halo=halo)
+    cached = load_cached_cube(cache_dir, key)
+    if cached is not None:
+        return cached
+
+    times, latitudes, longitudes, cube = extract_region_cube(date_file_list, vertices, case, halo=halo)
+    save_cached_cube(cache_dir, key, times, latitudes, longitudes, cube, max_bytes=max_bytes)
+    return times, latitudes, longitudes, cube
+
+### Output encodings
+
+# On-disk types of the SLA variables (in m) of the outputs; int16_mm stores millimetres
+SLA_ENCODINGS = {
+    'float64': {'dtype': 'float64'},
+    'float32': {'dtype': 'float32'},
+    'int16_mm': {'dtype': 'int16', 'scale_factor': 0.001, 'add_offset': 0.0, '_FillValue': np.int16(-32768)},
+}
+
+def sla_encoding(name='float32', compression='zlib', complevel=4, chunks=None, zarr=False):
+    """Encoding of an SLA variable for `to_netcdf` or `to_zarr`.
+
+    Args:
+        name (string, optional): key of SLA_ENCODINGS. Defaults to 'float32'.
+        compression (string, optional): 'zlib', 'zstd' or None. zstd needs a
+            netCDF-C library with the zstd filter (NetCDF) or numcodecs (Zarr).
+            Zarr keeps its default compressor for 'zlib'.
+        complevel (int, optional): compression level. Defaults to 4.
+        chunks (tuple, optional): chunk shape of the variable.
+        zarr (bool, optional): return a Zarr instead of a NetCDF4 encoding.
+    """
+    encoding = dict(SLA_ENCODINGS[name])
+    if zarr:
+        if chunks is not None:
+            encoding['chunks'] = chunks
+        if compression == 'zstd':
+            from numcodecs import Zstd
+            encoding['compressor'] = Zstd(level=complevel)
+        elif compression is None:
+            encoding['compressor'] = None
+        return encoding
+
+    if chunks is not None:
+        encoding['chunksizes'] = chunks
+    if compression == 'zlib':
+        encoding.update(zlib=True, complevel=complevel, shuffle=True)
+    elif compression is not None:
+        encoding.update(compression=compression, complevel=complevel, shuffle=True)
+    return encoding
+
+def encoding_report(data, dims, names=('float64', 'float32', 'int16_mm'), compressions=(None, 'zlib'),
+                    chunks=None, tmp_dir=None):
+    """Compare the size, write/read throughput and error of the SLA encodings on a sample.
+
+    Each combination of encoding and compression is written to a temporary
+    NetCDF file and read back.
+
+    Args:
+        data (numpy.ndarray): sample SLA array in m, e.g. a few days of a grid.
+        dims (list): dimension names of `data`.
+        chunks (tuple, optional): chunk shape passed to `sla_encoding`.
+        tmp_dir (string, optional): directory of the temporary files, e.g. on the
+            NFS share whose throughput matters.
+
+    Returns:
+        pandas.DataFrame: one row per combination, with the file size in MB, the
+        ratio to uncompressed float64, write and read speed in MB/s of float64
+        data and the maximum absolute error in m.
+    """
+    import tempfile
+    import time
+
+    data = np.asarray(data, dtype=float)
+    ds = xr.Dataset({'sla': (dims, data)})
+    data_mb = data.nbytes / 1e6
+    rows = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        for name in names:
+            for compression in compressions:
+                path = os.path.join(directory, f"{name}_{compression}.nc")
+                start = time.perf_counter()
+                ds.to_netcdf(path, encoding={'sla': sla_encoding(name, compression, chunks=chunks)})
+                write_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                with xr.open_dataset(path) as written:
+                    values = written['sla'].values
+                read_time = time.perf_counter() - start
+
+                size_mb = os.path.getsize(path) / 1e6
+                rows.append({
+                    'encoding': name, 'compression': compression or 'none', 'size_mb': size_mb,
+                    'ratio': size_mb / data_mb, 'write_mb_s': data_mb / write_time, 'read_mb_s': data_mb / read_time,
+                    'max_abs_error': float(np.nanmax(abs(values - data))) if np.isfinite(data).any() else 0.0,
+                })
+    return pd.DataFrame(rows)
+
+### Grid reconstruction
+
+def grid_indices(coords, values, tol=0.01):
+    """Index of the grid coordinate closest to each value, -1 where none is within `tol`."""
+    coords = np.asarray(coords, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if coords.size == 1:
+        return np.where(abs(values - coords[0]) < tol, 0, -1)
+
+    order = np.argsort(coords)
+    sorted_coords = coords[order]
+    pos = np.clip(np.searchsorted(sorted_coords, values), 1, len(coords) - 1)
+    pos -= (values - sorted_coords[pos - 1]) < (sorted_coords[pos] - values)  # Closer to the left neighbour
+    idx = order[pos]
+    return np.where(abs(coords[idx] - values) < tol, idx, -1)
+
+def place_series_in_grid(time_range, latitudes, longitudes, times, point_lat, point_lon, series, tol=0.01, cube=None):
+    """Place (time, point) series sharing one time axis directly into a (time, lat, lon) cube.
+
+    Each point is mapped to its grid cell once with `grid_indices` and each time
+    step to its day once with a searchsorted on `time_range`, then all values
+    are assigned at once. Points outside the grid and times outside
+    `time_range` are ignored.
+
+    Args:
+        cube (numpy.ndarray, optional): (time, lat, lon) cube to fill, e.g. to
+            place several groups of series. Defaults to a new NaN cube.
+
+    Returns:
+        numpy.ndarray: (time, lat, lon) cube, NaN where no series has a value.
+    """
+    time_range = pd.DatetimeIndex(time_range)
+    if cube is None:
+        cube = np.full((len(time_range), len(latitudes), len(longitudes)), np.nan)
+    if len(time_range) == 0 or len(times) == 0:
+        return cube
+
+    lat_idx = grid_indices(latitudes, point_lat, tol=tol)
+    lon_idx = grid_indices(longitudes, point_lon, tol=tol)
+    points = np.nonzero((lat_idx >= 0) & (lon_idx >= 0))[0]
+
+    times = np.asarray(times, dtype='datetime64[ns]')
+    range_values = time_range.values
+    time_idx = np.clip(np.searchsorted(range_values, times), 0, len(time_range) - 1)
+    steps = np.nonzero(range_values[time_idx] == times)[0]
+
+    cube[time_idx[steps][:, None], lat_idx[points], lon_idx[points]] = np.asarray(series)[steps][:, points]
+    return cube
+
+def scatter_series_to_cube(time_range, latitudes, longitudes, point_times, point_lat, point_lon, point_series, tol=0.01):
+    """Scatter point time series with their own time axes (e.g. read from per-point files) into a (time, lat, lon) cube.
+
+    The points sharing a time axis (usually all of them) are placed together
+    with `place_series_in_grid`, so every point is mapped to its cell and every
+    time step to its day only once.
+
+    Args:
+        point_times, point_series (list): time axis and values of each point.
+        point_lat, point_lon (array-like): position of each point.
+
+    Returns:
+        numpy.ndarray: (time, lat, lon) cube, NaN where no series has a value.
+    """
+    cube = np.full((len(time_range), len(latitudes), len(longitudes)), np.nan)
+    point_lat, point_lon = np.asarray(point_lat, dtype=float), np.asarray(point_lon, dtype=float)
+
+    groups = {}
+    for point, times in enumerate(point_times):
+        times = np.asarray(times, dtype='datetime64[ns]')
+        groups.setdefault(times.tobytes(), (times, []))[1].append(point)
+    for times, points in groups.values():
+        series = np.stack([np.asarray(point_series[point], dtype=float) for point in points], axis=1)
+        place_series_in_grid(time_range, latitudes, longitudes, times, point_lat[points], point_lon[points], series,
+                             tol=tol, cube=cube)
+    return cube
+
+def save_grid_cube(output_path, times, latitudes, longitudes, cube, time_chunk=32, space_chunk=64,
+                   encoding='float64', compression='zlib'):
+    """Save a reconstructed (time, lat, lon) SLA cube as one time-chunked, compressed file.
+
+    Alternative to one filtered_grid_YYYYMMDD.nc per day. The file is NetCDF4,
+    or a Zarr store if `output_path` ends with '.zarr'; the variable is `sla`
+    as in the daily files, encoded as given by `sla_encoding`.
+    """
+    ds = xr.Dataset(
+        {'sla': (['time', 'latitude', 'longitude'], cube)},
+        coords={'time': pd.to_datetime(times), 'latitude': latitudes, 'longitude': longitudes}
+    )
+    chunks = (max(min(time_chunk, len(ds['time'])), 1), max(min(space_chunk, len(ds['latitude'])), 1),
+              max(min(space_chunk, len(ds['longitude'])), 1))
+    zarr = output_path.endswith('.zarr')
+    sla_enc = {'sla': sla_encoding(encoding, compression, chunks=chunks, zarr=zarr)}
+    if zarr:
+        with stage_timer('write_grids', items=cube.size):
+            ds.to_zarr(output_path, mode='w', encoding=sla_enc)
+    else:
+        write_netcdf(ds, output_path, stage='write_grids', encoding=sla_enc)
+
+### Consolidated time series store
+
+def save_series_store(output_path, times, latitudes, longitudes, unfiltered, filtered,
+                      lat_indices=None, lon_indices=None, chunk_points=512, bands=None,
+                      encoding='float64', compression='zlib'):
+    """Save all grid point series of a run into one chunked (time, point) store.
+
+    Replaces the one-file-per-point layout of `save_to_netcdf`. The store is a
+    NetCDF4 file, or a Zarr store if `output_path` ends with '.zarr'.
+
+    Args:
+        output_path (string): path of the .nc file or .zarr store.
+        times (array-like): time axis shared by all series.
+        latitudes, longitudes (array-like): location of each point.
+        unfiltered, filtered (numpy.ndarray or dask.array.Array): (time, point)
+            SLA matrices. For a multi-band run `filtered` is (band, time, point).
+        lat_indices, lon_indices (array-like, optional): indices of each point
+            in the product grid, stored as coordinates for reconstruction.
+        chunk_points (int, optional): number of points per chunk. Each chunk
+            holds the full time axis, so reading a single series is one read.
+        bands (list, optional): (lowcut, highcut, order) of each band of a
+            multi-band `filtered`.
+        encoding, compression (string, optional): on-disk encoding of the SLA
+            variables, see `sla_encoding`.
+    """
+    coords = {
+        'time': pd.to_datetime(times),
+        'point': np.arange(len(latitudes)),
+        'latitude': ('point', np.asarray(latitudes, dtype=float)),
+        'longitude': ('point', np.asarray(longitudes, dtype=float)),
+    }
+    if lat_indices is not None and lon_indices is not None:
+        coords['lat_idx'] = ('point', np.asarray(lat_indices, dtype=int))
+        coords['lon_idx'] = ('point', np.asarray(lon_indices, dtype=int))
+
+    filtered_dims = ['time', 'point']
+    if bands is not None:
+        coords.update(band_coords(bands))
+        filtered_dims = ['band', 'time', 'point']
+
+    # numpy arrays are written at once, dask arrays are computed and streamed chunk by chunk
+    ds = xr.Dataset(
+        {
+            'unfiltered_sla': (['time', 'point'], unfiltered),
+            'filtered_sla': (filtered_dims, filtered),
+        },
+        coords=coords
+    )
+
+    chunks = {'band': 1, 'time': len(ds['time']), 'point': max(min(chunk_points, len(ds['point'])), 1)}
+    if ds.chunks:
+        ds = ds.chunk({d: c for d, c in chunks.items() if d in ds.dims})
+    var_chunks = {v: tuple(chunks[d] for d in ds[v].dims) for v in ['unfiltered_sla', 'filtered_sla']}
+    zarr = output_path.endswith('.zarr')
+    var_encoding = {v: sla_encoding(encoding, compression, chunks=var_chunks[v], zarr=zarr) for v in var_chunks}
+    if zarr:
+        with stage_timer('write_store', items=len(ds['point'])):
+            ds.to_zarr(output_path, mode='w', encoding=var_encoding)
+    else:
+        write_netcdf(ds, output_path, stage='write_store', encoding=var_encoding)
+
+def series_store_from_directory(input_dir, output_path, chunk_points=512):
+    """Convert a directory of filtered_sla_lat_XX_lon_YY.nc files into one store.
+
+    Series are aligned on the union of their time axes, missing days are NaN.
+    """
+    file_names = sorted(f for f in os.listdir(input_dir) if f.startswith('filtered_sla_lat_') and f.endswith('.nc'))
+    if not file_names:
+        raise FileNotFoundError(f"No per-point series found in {input_dir}.")
+
+    series = []
+    for file_name in file_names:
+        with xr.open_dataset(os.path.join(input_dir, file_name)) as ds:
+            series.append(ds[['unfiltered_sla', 'filtered_sla']].load())
+
+    times = pd.DatetimeIndex(np.unique(np.concatenate([ds['time'].values for ds in series])))
+    unfiltered = np.full((len(times), len(series)), np.nan)
+    filtered = np.full((len(times), len(series)), np.nan)
+    for k, ds in enumerate(series):
+        time_idx = times.get_indexer(ds['time'].values)
+        unfiltered[time_idx, k] = ds['unfiltered_sla'].values
+        filtered[time_idx, k] = ds['filtered_sla'].values
+
+    latitudes = [float(ds['latitude']) for ds in series]
+    longitudes = [float(ds['longitude']) for ds in series]
+    save_series_store(output_path, times, latitudes, longitudes, unfiltered, filtered, chunk_points=chunk_points)
+
+def open_series_store(store_path):
+    """Open a consolidated (time, point) store written by `save_series_store`."""
+    if store_path.rstrip('/').endswith('.zarr'):
+        return xr.open_zarr(store_path)
+    return xr.open_dataset(store_path)
+
+def get_store_grid_points(store):
+    """Return the (lon, lat) pairs of all points in the store, indexed by point."""
+    return np.column_stack([store['longitude'].values, store['latitude'].values])
+
+def find_closest_point(store, lat, lon, nan_threshold=None):
+    """Find the store point closest to a latitude/longitude location.
+
+    Args:
+        store (xarray.Dataset): store opened with `open_series_store`.
+        lat, lon (float): location to search for.
+        nan_threshold (float, optional): if given, skip points whose unfiltered
+            series has a NaN fraction of `nan_threshold` or more.
+
+    Returns:
+        int, float: point index and distance in degrees, or (None, inf) if no
+            point qualifies.
+    """
+    distance = np.sqrt((store['latitude'].values - lat)**2 + (store['longitude'].values - lon)**2)
+    if nan_threshold is not None:
+        nan_fraction = store['unfiltered_sla'].isnull().mean(dim='time').values
+        distance = np.where(nan_fraction < nan_threshold, distance, np.inf)
+    if distance.size == 0 or np.isinf(distance.min()):
+        return None, float('inf')
+    point = int(np.argmin(distance))
+    return point, float(distance[point])
+
+def read_point_series(store, point, variable='filtered_sla', band=None):
+    """Return the series of one or several store points as a numpy array.
+
+    For a multi-band store, `band` selects the band (all bands if None).
+    """
+    data = store[variable].isel(point=point)
+    if band is not None and 'band' in data.dims:
+        data = data.isel(band=band)
+    return data.values
+
+### Run manifest
+
+def file_list_signature(paths):
+    """Return (path, mtime, size) of every input file, to detect changed inputs."""
+    signature = []
+    for path in paths:
+        stat = os.stat(path)
+        signature.append((path, stat.st_mtime, stat.st_size))
+    return signature
+
+class RunManifest:
+    """Record of the work units finished by a run, so that a rerun can skip them.
+
+    The manifest is a text file next to the outputs: a JSON header with the run
+    key, followed by one finished unit (e.g. an output file name) per line. Lines
+    are appended and flushed as work completes, so a run that dies partway keeps
+    everything finished up to that point. If the run key changes (other case,
+    dates, band or modified input files) the manifest is stale and starts over.
+    """
+
+    def __init__(self, path, key, params=None):
+        """Open or create the manifest.
+
+        Args:
+            path (string): path of the manifest file.
+            key (string): run key, see `run_key`.
+            params (dict, optional): run parameters, stored in the header for
+                reference.
+        """
+        self.path = path
+        self.key = key
+        self.done = set()
+        self._lock = threading.Lock()  # mark_done may be called from writer threads
+
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.read().splitlines()
+            if lines and json.loads(lines[0]).get('key') == key:
+                self.done = set(line for line in lines[1:] if line)
+                return
+
+        # New or stale manifest: start over
+        header = {'key': key, 'params': params or {}}
+        with open(path, 'w') as f:
+            f.write(json.dumps(header, sort_keys=True, default=str) + '\n')
+
+    def is_done(self, unit):
+        """Check if a work unit was finished by this or a previous run."""
+        return unit in self.done
+
+    def mark_done(self, unit):
+        """Record a finished work unit."""
+        with self._lock:
+            if unit in self.done:
+                return
+            with open(self.path, 'a') as f:
+                f.write(unit + '\n')
+            self.done.add(unit)
+
+### Tile scheduler
+
+def make_tiles(lat_indices, lon_indices, tile_size=16):
+    """Partition grid points into square spatial tiles of `tile_size` cells.
+
+    Returns:
+        list: one dict per tile with its 'key' (e.g. 'tile_0_3') and the
+            positions of its grid points in `lat_indices`/`lon_indices`.
+    """
+    lat_tiles = np.asarray(lat_indices) // tile_size
+    lon_tiles = np.asarray(lon_indices) // tile_size
+    tiles = {}
+    for position, tile in enumerate(zip(lat_tiles, lon_tiles)):
+        tiles.setdefault(tile, []).append(position)
+    return [{'key': f"tile_{tile[0]}_{tile[1]}", 'points': np.array(points)}
+            for tile, points in sorted(tiles.items())]
+
+### L4 file catalog
+
+class CmemsAdapter:
+    """CMEMS L4: one subdirectory per month ("01" to "12"), files named ..._YYYYMMDD_YYYYMMDD.nc."""
+
+    def directories(self, base_dir):
+        month_dirs = [os.path.join(base_dir, f"{month:02d}") for month in range(1, 13)]
+        return [month_dir for month_dir in month_dirs if os.path.exists(month_dir)]
+
+    def parse_date(self, file_name):
+        return datetime.strptime(file_name.split('_')[-2], "%Y%m%d")
+
+class SwotAdapter:
+    """SWOT/MIOST L4: all files in the base directory, named ..._YYYYMMDD_YYYYMMDD.nc."""
+
+    def directories(self, base_dir):
+        return [base_dir]
+
+    def parse_date(self, file_name):
+        return datetime.strptime(file_name.split('_')[-2], "%Y%m%d")
+
+class BluelinkAdapter:
+    """BLUELINK daily grids from model_data_reader: dt_global_allsat_phy_l4_YYYYMMDD.nc."""
+
+    def directories(self, base_dir):
+        return [base_dir]
+
+    def parse_date(self, file_name):
+        return datetime.strptime(file_name.split('_')[-1].replace('.nc', ''), "%Y%m%d")
+
+# Directory layout and filename convention of each product
+PRODUCT_ADAPTERS = {
+    'CMEMS': CmemsAdapter(),
+    'SWOT': SwotAdapter(),
+    'BLUELINK': BluelinkAdapter(),
+}
+
+class FileCatalog:
+    """Persistent index of the daily files of an L4 product directory.
+
+    The catalog maps every file to its date and keeps the grid shape and
+    variable names of the product. It is saved as JSON and refreshed
+    incrementally: a directory is only listed again if its modification time
+    changed, i.e. if files were added or removed. Date-range queries are then
+    answered from the index without touching the filesystem.
+    """
+
+    def __init__(self, base_dir, case, catalog_file=None, refresh=True):
+        """Load (and by default refresh) the catalog of a product directory.
+
+        Args:
+            base_dir (string): product directory, as in create_filtered_time_series.main.
+            case (string): product, one of PRODUCT_ADAPTERS ('CMEMS', 'SWOT', 'BLUELINK').
+            catalog_file (string, optional): where to keep the catalog. Defaults
+                to ~/.cache/ctw_catalog/<case>_<hash of base_dir>.json.
+            refresh (bool, optional): look for new or removed files. Defaults to True.
+        """
+        self.base_dir = base_dir
+        self.case = case
+        self.adapter = PRODUCT_ADAPTERS[case]
+        if catalog_file is None:
+            dir_hash = hashlib.sha1(os.path.abspath(base_dir).encode()).hexdigest()[:12]
+            catalog_file = os.path.join(os.path.expanduser('~'), '.cache', 'ctw_catalog', f"{case}_{dir_hash}.json")
+        self.catalog_file = catalog_file
+
+        self.directories = {}  # directory -> modification time when last listed
+        self.dates = {}  # file path -> date as YYYYMMDD
+        self.grid = {}  # dims and variables of the product
+        if os.path.exists(catalog_file):
+            with open(catalog_file) as f:
+                stored = json.load(f)
+            if stored.get('base_dir') == base_dir and stored.get('case') == case:
+                self.directories = stored['directories']
+                self.dates = stored['dates']
+                self.grid = stored['grid']
+
+        if refresh:
+            self.refresh()
+
+    def refresh(self):
+        """Index new files and drop removed ones, listing only the directories that changed."""
+        changed = False
+        directories = self.adapter.directories(self.base_dir)
+
+        for directory in set(self.directories) - set(directories):
+            self._drop_directory(directory)
+            changed = True
+
+        for directory in directories:
+            mtime = os.stat(directory).st_mtime
+            if self.directories.get(directory) == mtime:
+                continue
+
+            self._drop_directory(directory)
+            for file_name in os.listdir(directory):
+                if file_name.endswith('.nc'):
+                    file_date = self.adapter.parse_date(file_name)
+                    self.dates[os.path.join(directory, file_name)] = file_date.strftime("%Y%m%d")
+            self.directories[directory] = mtime
+            changed = True
+
+        if self.dates and not self.grid:
+            self.grid = self._read_grid(min(self.dates))
+            changed = True
+        if changed:
+            self.save()
+
+    def _drop_directory(self, directory):
+        self.directories.pop(directory, None)
+        for path in [path for path in self.dates if os.path.dirname(path) == directory]:
+            del self.dates[path]
+
+    def _read_grid(self, file_path):
+        lat_dim, lon_dim = product_dims(self.case)
+        with xr.open_dataset(file_path) as dataset:
+            return {
+                'lat_dim': lat_dim, 'lon_dim': lon_dim,
+                'shape': [int(dataset.sizes[lat_dim]), int(dataset.sizes[lon_dim])],
+                'variables': sorted(dataset.data_vars),
+            }
+
+    def save(self):
+        """Write the catalog to its JSON file."""
+        os.makedirs(os.path.dirname(self.catalog_file), exist_ok=True)
+        stored = {'base_dir': self.base_dir, 'case': self.case, 'directories': self.directories,
+                  'dates': self.dates, 'grid': self.grid}
+        tmp_file = self.catalog_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(stored, f)
+        os.replace(tmp_file, self.catalog_file)
+
+    def files(self, start_date=None, end_date=None):
+        """Return the sorted (date, path) list of the files between start_date and end_date (inclusive)."""
+        date_file_list = []
+        for file_path, date_str in self.dates.items():
+            file_date = datetime.strptime(date_str, "%Y%m%d")
+            if (start_date is None or start_date <= file_date) and (end_date is None or file_date <= end_date):
+                date_file_list.append((file_date, file_path))
+        return sorted(date_file_list)
+
+### Background writer
+
+class BackgroundWriter:
+    """Run NetCDF writes in the background while the computation continues.
+
+    Writes are submitted to a small pool of writer threads (or processes, which
+    avoids serialising on the HDF5 lock). At most `max_queue` writes are pending:
+    `submit` blocks beyond that, so a slow filesystem slows the computation down
+    instead of filling the memory. Pending writes are flushed by `flush`, `close`,
+    at the end of a `with` block and at interpreter exit.
+    """
+
+    def __init__(self, n_writers=2, max_queue=16, use_processes=False):
+        """Start the writer pool.
+
+        Args:
+            n_writers (int, optional): number of writer threads/processes. Defaults to 2.
+            max_queue (int, optional): maximum number of pending writes. Defaults to 16.
+            use_processes (bool, optional): write in processes instead of threads.
+                The submitted function and its arguments must then be picklable.
+        """
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.executor = executor_class(max_workers=n_writers)
+        self.use_processes = use_processes
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.errors = []
+        # Writes submitted and not yet finished, including their on_done and error recording
+        self.n_pending = 0
+        self._finished_writes = threading.Condition()
+        self.closed = False
+        atexit.register(self.close)
+
+    def submit(self, func, *args, on_done=None, **kwargs):
+        """Queue `func(*args, **kwargs)`, e.g. `dataset.to_netcdf(path)`.
+
+        Args:
+            on_done (callable, optional): called without arguments once the write
+                succeeded, e.g. to record it in a RunManifest.
+        """
+        self.slots.acquire()  # Backpressure: wait while max_queue writes are pending
+        try:
+            if self.use_processes:
+                # Bring the stage metrics of the writer process back with the result
+                future = self.executor.submit(call_with_metrics, func, *args, **kwargs)
+            else:
+                future = self.executor.submit(func, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        with self._finished_writes:
+            self.n_pending += 1
+        future.add_done_callback(functools.partial(self._finished, on_done=on_done))
+        return future
+
+    def _finished(self, future, on_done=None):
+        try:
+            if future.exception() is not None:
+                with self._finished_writes:
+                    self.errors.append(future.exception())
+            else:
+                if self.use_processes:
+                    merge_metrics(future.result()[1])
+                if on_done is not None:
+                    on_done()
+        except Exception as e:
+            with self._finished_writes:
+                self.errors.append(e)
+        finally:
+            self.slots.release()
+            with self._finished_writes:
+                self.n_pending -= 1
+                self._finished_writes.notify_all()
+
+    def flush(self):
+        """Wait for all pending writes and their on_done; raise the first error of a failed write."""
+        with self._finished_writes:
+            self._finished_writes.wait_for(lambda: self.n_pending == 0)
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        """Flush the pending writes and stop the writer pool."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+            atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
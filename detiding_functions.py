@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+import numpy as np
+from scipy import ndimage
+from pipeline_functions import share_array, attach_shared_array, run_tiles, stage_timer
+
+### Lowess
+
+# Function to compute the tricube weights (1 - d^3)^3 of distances d in units of the radius
+def tricube(d):
+    return (1.0 - np.clip(d, 0.0, 1.0) ** 3) ** 3
+
+# Function to compute the bisquare residual weights of the robustifying iterations
+def residual_weights(y, y_fit):
+    residuals = np.abs(y - y_fit)
+    median = np.median(residuals)
+    if median == 0:
+        scaled = (residuals > 0).astype(float)
+    else:
+        scaled = np.minimum(residuals / (6.0 * median), 1.0)
+    return (1.0 - scaled ** 2) ** 2
+
+# Function to select the points where the local regression is run when delta > 0
+def delta_fit_points(x, delta):
+    """Indices of the points fitted by regression, the others are interpolated
+    linearly. As in statsmodels, after fitting x[i] the next fit is the last
+    point within delta of x[i] (but at least the next point)."""
+    if delta <= 0:
+        return np.arange(len(x))
+    fit_points = [0]
+    while fit_points[-1] < len(x) - 1:
+        i = fit_points[-1]
+        # First point beyond delta; when there is none statsmodels stops its scan at the last point
+        k = min(np.searchsorted(x, x[i] + delta, side='right'), len(x) - 1)
+        fit_points.append(max(k - 1, i + 1))
+    return np.array(fit_points)
+
+def local_linear_fit(x, y, fit_points, k, robustness, max_elements=4_000_000):
+    """Local linear regressions of lowess at x[fit_points], vectorized over the points.
+
+    The neighbourhood of each point is the window of k consecutive (sorted) x
+    values that statsmodels selects, weighted with the tricube of the distance
+    and the residual weights `robustness`. The windows are processed in blocks
+    of at most `max_elements` (points x k) values.
+    """
+    n = len(x)
+    # Window start: move right while x_i is past the midpoint of x[left] and x[left + k]
+    midpoints = (x[:n - k] + x[k:]) / 2.0
+    y_fit = np.empty(len(fit_points))
+    block = max(max_elements // k, 1)
+    offsets = np.arange(k)
+    for start in range(0, len(fit_points), block):
+        points = fit_points[start:start + block]
+        x_i = x[points]
+        left = np.searchsorted(midpoints, x_i, side='left')
+        window = left[:, None] + offsets
+        x_w = x[window]
+        radius = np.maximum(x_i - x[left], x[left + k - 1] - x_i)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = tricube(np.abs(x_w - x_i[:, None]) / radius[:, None]) * robustness[window]
+        regression_ok = (weights > 1e-12).sum(axis=1) >= 2
+        weights /= np.where(regression_ok, weights.sum(axis=1), 1.0)[:, None]
+
+        # Weighted linear regression evaluated at x_i, as a projection of y on the window
+        mean_x = (weights * x_w).sum(axis=1)
+        sqdev_x = np.maximum((weights * (x_w - mean_x[:, None]) ** 2).sum(axis=1), 1e-12)
+        projection = weights * (1.0 + (x_i - mean_x)[:, None] * (x_w - mean_x[:, None]) / sqdev_x[:, None])
+        y_fit[start:start + block] = np.where(regression_ok, (projection * y[window]).sum(axis=1), y[points])
+    return y_fit
+
+def lowess_smooth(y, x=None, frac=2.0 / 3.0, it=3, delta=0.0):
+    """Lowess smoothing of one series, equivalent to statsmodels'
+    `sm.nonparametric.lowess(y, x, frac=frac, it=it, delta=delta)` but with
+    the local regressions of all points computed at once with numpy.
+
+    Args:
+        y (numpy.ndarray): series, NaNs are ignored (missing='drop').
+        x (numpy.ndarray, optional): sorted positions. Defaults to 0..n-1.
+        frac (float, optional): fraction of the valid points in each local
+            regression. Defaults to 2/3.
+        it (int, optional): number of robustifying iterations. Defaults to 3.
+        delta (float, optional): points within delta of the last fitted point
+            are linearly interpolated instead of fitted. Defaults to 0.
+
+    Returns:
+        numpy.ndarray: smoothed series on the positions of y, NaN where y is NaN.
+    """
+    y = np.asarray(y, dtype=float)
+    x = np.arange(len(y), dtype=float) if x is None else np.asarray(x, dtype=float)
+    smoothed = np.full(len(y), np.nan)
+    valid = np.isfinite(y) & np.isfinite(x)
+    n = int(valid.sum())
+    if n < 2:
+        smoothed[valid] = y[valid]
+        return smoothed
+
+    x_valid, y_valid = x[valid], y[valid]
+    k = min(max(int(frac * n + 1e-10), 2), n)
+    fit_points = delta_fit_points(x_valid, delta)
+    robustness = np.ones(n)
+    for iteration in range(it + 1):
+        y_fit = local_linear_fit(x_valid, y_valid, fit_points, k, robustness)
+        if len(fit_points) < n:
+            y_fit = np.interp(x_valid, x_valid[fit_points], y_fit)
+        robustness = residual_weights(y_valid, y_fit)
+    smoothed[valid] = y_fit
+    return smoothed
+
+### Tidal filters
+
+# Function to build the Godin filter: 24, 24 and 25 hour running means in sequence
+def godin_weights():
+    weights = np.convolve(np.ones(24) / 24, np.ones(24) / 24)
+    return np.convolve(weights, np.ones(25) / 25)
+
+# Function to build the Doodson X0 filter (39 hourly weights, sum 30)
+def doodson_weights():
+    weights = np.array([1, 0, 1, 0, 0, 1, 0, 1, 1, 0, 2, 0, 1, 1, 0, 2, 1, 1, 2, 0,
+                        2, 1, 1, 2, 0, 1, 1, 0, 2, 0, 1, 1, 0, 1, 0, 0, 1, 0, 1], dtype=float)
+    return weights / weights.sum()
+
+TIDAL_FILTERS = {'godin': godin_weights, 'doodson': doodson_weights}
+
+def tidal_filter(data, method='godin', min_weight=1.0):
+    """Remove the tides from hourly series with a Godin or Doodson X0 filter,
+    as one convolution along the last axis of a (station, time) array.
+
+    Args:
+        data (numpy.ndarray): hourly series, time along the last axis.
+        method (string, optional): 'godin' or 'doodson'. Defaults to 'godin'.
+        min_weight (float, optional): fraction of the filter weight that must
+            fall on valid (non-NaN) hours; missing hours are left out and the
+            remaining weights renormalized. 1.0 requires a complete window.
+
+    Returns:
+        numpy.ndarray: filtered series, NaN where the window is not covered
+            enough (including the first and last half-window).
+    """
+    weights = TIDAL_FILTERS[method]()  # Symmetric, odd length: centred on each hour
+    data = np.asarray(data, dtype=float)
+    valid = np.isfinite(data)
+    total = ndimage.convolve1d(np.where(valid, data, 0.0), weights, axis=-1, mode='constant', cval=0.0)
+    covered = ndimage.convolve1d(valid.astype(float), weights, axis=-1, mode='constant', cval=0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        filtered = total / covered
+    filtered[covered < min_weight - 1e-9] = np.nan
+    return filtered
+
+### Parallel detiding of GESLA datasets
+
+# State of a detiding worker process, set once per process by init_detide_worker
+_detide_state = {}
+
+def init_detide_worker(state):
+    _detide_state.update(state)
+    for name in ['series', 'smoothed']:
+        _detide_state[name + '_shm'], _detide_state[name] = attach_shared_array(state[name])
+
+# Function to smooth the stations of one tile, writing into the shared output array
+def lowess_tile(tile):
+    series, smoothed = _detide_state['series'], _detide_state['smoothed']
+    with stage_timer('lowess', items=len(tile['points'])):
+        for station in tile['points']:
+            smoothed[station] = lowess_smooth(series[station], frac=_detide_state['frac'],
+                                              it=_detide_state['it'], delta=_detide_state['delta'])
+
+def lowess_stations(data, frac, it=3, delta=0.0, stations_per_task=8, max_workers=None):
+    """`lowess_smooth` of every row of a (station, time) array on a process pool.
+
+    The array and the result are shared with the workers through shared memory;
+    max_workers=1 runs in this process.
+    """
+    data = np.asarray(data, dtype=float)
+    tiles = [{'key': f"stations_{start}", 'points': np.arange(start, min(start + stations_per_task, len(data)))}
+             for start in range(0, len(data), stations_per_task)]
+    if max_workers == 1:
+        smoothed = np.full(data.shape, np.nan)
+        _detide_state.update(series=data, smoothed=smoothed, frac=frac, it=it, delta=delta)
+        for tile in tiles:
+            lowess_tile(tile)
+        _detide_state.clear()
+        return smoothed
+
+    series_shm, series_ref = share_array(data)
+    smoothed_shm, smoothed_ref = share_array(np.full(data.shape, np.nan))
+    try:
+        state = {'series': series_ref, 'smoothed': smoothed_ref, 'frac': frac, 'it': it, 'delta': delta}
+        run_tiles(lowess_tile, tiles, initializer=init_detide_worker, initargs=(state,),
+                  max_workers=max_workers, progress=False)
+        smoothed = np.ndarray(data.shape, dtype=float, buffer=smoothed_shm.buf).copy()
+    finally:
+        for shm in [series_shm, smoothed_shm]:
+            shm.close()
+            shm.unlink()
+    return smoothed
+
+def detide(dataset, method='lowess', variable='sea_level', output='sea_level_lowess', window_hours=40,
+           frac=None, it=3, delta=0.0, min_weight=1.0, max_workers=None):
+    """Add the detided sea level of a GESLA (station, date_time) dataset, as
+    the variable `sea_level_lowess` used by the DAC correction.
+
+    Args:
+        dataset (xarray.Dataset): hourly GESLA dataset, e.g. from
+            select_and_dropdupl.
+        method (string, optional): 'lowess', 'godin' or 'doodson'. Defaults to
+            'lowess'.
+        variable (string, optional): input variable. Defaults to 'sea_level'.
+        output (string, optional): output variable. Defaults to 'sea_level_lowess'.
+        window_hours (float, optional): lowess window in hours; as in the
+            processing notebooks, frac = window_hours / len(date_time).
+        frac (float, optional): lowess fraction, overrides window_hours.
+        it, delta: lowess robustifying iterations and interpolation distance
+            (in hours), see lowess_smooth.
+        min_weight (float, optional): required filter weight on valid hours for
+            the Godin/Doodson filters, see tidal_filter.
+        max_workers (int, optional): worker processes for lowess. Defaults to
+            the number of CPUs.
+
+    Returns:
+        xarray.Dataset: the dataset with the `output` variable added.
+    """
+    sea_level = dataset[variable].transpose('station', 'date_time')
+    with stage_timer('detide', items=sea_level.sizes['station']):
+        if method == 'lowess':
+            frac = window_hours / sea_level.sizes['date_time'] if frac is None else frac
+            detided = lowess_stations(sea_level.values, frac, it=it, delta=delta, max_workers=max_workers)
+        else:
+            detided = tidal_filter(sea_level.values, method=method, min_weight=min_weight)
+    dataset[output] = (('station', 'date_time'), detided)
+    dataset[output].attrs['detiding'] = method
+    return dataset
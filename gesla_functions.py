@@ -7,6 +7,9 @@ import numpy as np
 import xarray as xr
 import pandas as pd
 import os
+import io
+from datetime import datetime
+import mmap
 import sys
 from os.path import dirname
 sys.path.append(dirname('/home/nemo/work_julius/vlad_globcoast/scripts/'))
@@ -23,9 +26,12 @@ from typing import Union
 
 import multiprocessing
 import multiprocessing.pool
-from contextlib import closing
+from contextlib import closing, nullcontext
 from multiprocessing import Pool
 #from nctoolbox_utils import *
+from scipy.spatial import cKDTree
+from pipeline_functions import stage_timer, write_metrics_summary, run_key, run_tiles, points_in_polygon
+from pipeline_functions import save_cache_entry
 
 
 
@@ -371,6 +377,482 @@ def compute_S6_time_series_for_datasets(start_pool = True,pool_workers=10):
         
 ### GESLA        
 
+GESLA_HEADER_LINES = 41
+GESLA_COLUMNS = ["date", "time", "sea_level", "qc_flag", "use_flag"]
+GESLA_DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+
+# Function to find the byte offset of the first data line that starts after the header
+def _gesla_data_start(buffer, header_lines=GESLA_HEADER_LINES):
+    offset = 0
+    for _ in range(header_lines):
+        offset = buffer.find(b"\n", offset) + 1
+        if offset == 0:
+            return len(buffer)
+    return offset
+
+
+# Function to bisect a chronologically sorted GESLA record for the first line not earlier than key
+def _gesla_seek(buffer, lo, hi, key):
+    """Return the offset of the first line in buffer[lo:hi] whose leading
+    'YYYY/MM/DD HH:MM:SS' stamp is not earlier than key. Both lo and hi must
+    be line starts; the fixed-width stamps compare correctly as bytes."""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = max(buffer.rfind(b"\n", lo, mid) + 1, lo)
+        end = buffer.find(b"\n", start, hi)
+        end = hi if end == -1 else end
+        if buffer[start:start + 19] < key:
+            lo = end + 1
+        else:
+            hi = start
+    return min(lo, len(buffer))
+
+
+# Function to find the first or last timestamp of a GESLA record that passes the use flag
+def _gesla_record_bound(buffer, data_start, apply_use_flag, last=False):
+    end = len(buffer)
+    start = data_start
+    while start < end:
+        if last:
+            line_start = buffer.rfind(b"\n", data_start, end - 1) + 1
+            line_start = max(line_start, data_start)
+            line, end = buffer[line_start:end], line_start
+        else:
+            line_end = buffer.find(b"\n", start, end)
+            line_end = end if line_end == -1 else line_end
+            line, start = buffer[start:line_end], line_end + 1
+        fields = line.split()
+        if len(fields) == 5 and (not apply_use_flag or int(fields[4]) == 1):
+            return pd.to_datetime(
+                (fields[0] + b" " + fields[1]).decode(), format=GESLA_DATE_FORMAT
+            ).as_unit("ns")
+    return None
+
+
+# Function to parse the fixed-width GESLA timestamps with numpy, returns None if the layout differs
+def _gesla_numpy_dates(buffer):
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    starts = np.concatenate([[0], np.flatnonzero(raw == 10) + 1])
+    starts = starts[starts + 19 <= raw.size]
+    if starts.size == 0:
+        return np.array([], dtype="datetime64[ns]")
+    separators = {4: b"/", 7: b"/", 10: b" ", 13: b":", 16: b":"}
+    for position, char in separators.items():
+        if not np.all(raw[starts + position] == ord(char)):
+            return None
+    digits = [raw[starts + k].astype(np.int64) - 48 for k in range(19)]
+    if not all(np.all((d >= 0) & (d <= 9)) for k, d in enumerate(digits) if k not in separators):
+        return None
+    year = digits[0] * 1000 + digits[1] * 100 + digits[2] * 10 + digits[3]
+    month = digits[5] * 10 + digits[6]
+    day = digits[8] * 10 + digits[9]
+    seconds = (digits[11] * 10 + digits[12]) * 3600 + (digits[14] * 10 + digits[15]) * 60 \
+        + digits[17] * 10 + digits[18]
+    dates = (year - 1970).astype("datetime64[Y]") + (month - 1).astype("timedelta64[M]")
+    dates = dates.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")
+    return (dates + seconds.astype("timedelta64[s]")).astype("datetime64[ns]")
+
+
+# Function to parse the data lines of a GESLA file into a DataFrame indexed by date_time
+def parse_gesla_rows(buffer, engine="numpy"):
+    """Parse GESLA data lines (no header) into a pandas.DataFrame.
+
+    Args:
+        buffer (bytes): raw data lines "date time sea_level qc_flag use_flag".
+        engine (str, optional): 'numpy' decodes the fixed-width timestamps
+            with vectorized byte arithmetic and tokenizes only the numeric
+            columns; 'pandas' parses the timestamps with an explicit format.
+            The numpy engine falls back to pandas if a line does not follow
+            the fixed layout. Defaults to 'numpy'.
+
+    Returns:
+        pandas.DataFrame: sea_level, qc_flag and use_flag with a date_time index.
+    """
+    if not buffer.strip():
+        data = pd.DataFrame({
+            "sea_level": np.array([], dtype=np.float64),
+            "qc_flag": np.array([], dtype=np.int64),
+            "use_flag": np.array([], dtype=np.int64),
+        })
+        data.index = pd.DatetimeIndex([], dtype="datetime64[ns]", name="date_time")
+        return data
+    dates = _gesla_numpy_dates(buffer) if engine == "numpy" else None
+    if dates is not None:
+        data = pd.read_csv(
+            io.BytesIO(buffer),
+            names=GESLA_COLUMNS,
+            usecols=GESLA_COLUMNS[2:],
+            sep=r"\s+",
+            dtype={"sea_level": np.float64, "qc_flag": np.int64, "use_flag": np.int64},
+        )
+        if len(data) == len(dates):
+            data.index = pd.DatetimeIndex(dates, name="date_time")
+            return data
+    data = pd.read_csv(
+        io.BytesIO(buffer),
+        names=GESLA_COLUMNS,
+        sep=r"\s+",
+        dtype={"date": str, "time": str},
+    )
+    data.index = pd.DatetimeIndex(
+        pd.to_datetime(data.pop("date") + " " + data.pop("time"), format=GESLA_DATE_FORMAT),
+        name="date_time",
+    ).as_unit("ns")
+    return data
+
+
+### GESLA station cache
+
+# Record layout of a cached station: the parsed file as one memory-mappable array
+GESLA_CACHE_DTYPE = np.dtype([
+    ("date_time", "datetime64[ns]"),
+    ("sea_level", np.float64),
+    ("qc_flag", np.int8),
+    ("use_flag", np.int8),
+])
+
+
+def gesla_cache_file(cache_dir, path):
+    """Cache file of a GESLA station: named after the station (absolute path of the
+    file, so that stations of different data_path directories sharing a file name
+    do not collide) and the version of the source (modification time and size),
+    so an edited or replaced source file is parsed again."""
+    station_key = run_key(path=os.path.abspath(path))[:16]
+    version_key = run_key(mtime=os.path.getmtime(path), size=os.path.getsize(path))[:16]
+    return os.path.join(cache_dir, f"gesla_{station_key}_{version_key}.npy")
+
+
+def load_cached_station(cache_file):
+    """Load a cached GESLA station as a read-only memory map, or return None."""
+    if not os.path.exists(cache_file):
+        return None
+    os.utime(cache_file)  # Mark as recently used for the LRU eviction
+    return np.load(cache_file, mmap_mode='r')
+
+
+def save_cached_station(cache_file, data, max_bytes=5 * 1024**3):
+    """Store a parsed GESLA station (all rows, as read) in the cache, drop older
+    versions of the same station, then evict the least recently used stations
+    until the cache is below `max_bytes`."""
+    cache_dir, file_name = os.path.split(cache_file)
+    records = np.empty(len(data), dtype=GESLA_CACHE_DTYPE)
+    records["date_time"] = data.index.values
+    for column in ["sea_level", "qc_flag", "use_flag"]:
+        records[column] = data[column].values
+
+    # Older versions of the station (edited or replaced source file) are never read again
+    if os.path.isdir(cache_dir):
+        station_prefix = file_name[:len('gesla_') + 16]
+        for old_file in os.listdir(cache_dir):
+            if old_file.startswith(station_prefix) and old_file != file_name and '.tmp' not in old_file:
+                try:
+                    os.remove(os.path.join(cache_dir, old_file))
+                except FileNotFoundError:  # Removed meanwhile by another process
+                    pass
+    save_cache_entry(cache_dir, file_name[:-len('.npy')], {'.npy': lambda path: np.save(path, records)},
+                     max_bytes, prefix='gesla_')
+    return records
+
+
+# Function to cut the window from start_date to end_date out of cached records and find the record bounds
+def _select_cached_records(records, start_date, end_date, resampling, apply_use_flag):
+    lo, hi, bounds = 0, len(records), None
+    if start_date != None:
+        times = records["date_time"]
+        lo = np.searchsorted(times, np.datetime64(start_date - pd.Timedelta(days=1), 'ns'))
+        hi = np.searchsorted(times, np.datetime64(end_date + pd.Timedelta(days=1), 'ns'))
+        if resampling != None:
+            kept = np.flatnonzero(records["use_flag"] == 1) if apply_use_flag else np.arange(len(records))
+            bounds = (None, None) if kept.size == 0 else \
+                tuple(pd.Timestamp(records["date_time"][i]).as_unit("ns") for i in (kept[0], kept[-1]))
+    window = np.asarray(records[lo:hi])
+    data = pd.DataFrame({
+        "sea_level": window["sea_level"],
+        "qc_flag": window["qc_flag"].astype(np.int64),
+        "use_flag": window["use_flag"].astype(np.int64),
+    })
+    data.index = pd.DatetimeIndex(window["date_time"], name="date_time")
+    return data, bounds
+
+
+### GESLA station index
+
+# Earth radius of the great-circle distances, the one of haversine
+EARTH_RADIUS_KM = 6372.8
+
+def lat_lon_to_unit_vectors(latitudes, longitudes):
+    """(..., 3) unit vectors of points on the sphere, so that straight-line
+    (chord) distances order points like great-circle distances."""
+    lat = np.radians(np.asarray(latitudes, dtype=float))
+    lon = np.radians(np.asarray(longitudes, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+
+def km_to_chord(distance_km):
+    return 2 * np.sin(np.minimum(np.asarray(distance_km, dtype=float) / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+class StationIndex:
+    """KD-tree over station positions as unit vectors, for k-nearest, radius and
+    polygon queries with great-circle distances (correct across the dateline and
+    near the poles). Queries accept scalars or arrays of points; results are
+    positions in the latitude/longitude arrays the index was built from.
+    Stations without a finite position are never returned."""
+
+    def __init__(self, latitudes, longitudes):
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        self.positions = np.flatnonzero(np.isfinite(self.latitudes) & np.isfinite(self.longitudes))
+        self.tree = cKDTree(lat_lon_to_unit_vectors(self.latitudes[self.positions],
+                                                    self.longitudes[self.positions]))
+
+    def nearest(self, lat, lon, k=1):
+        """Distances (km) and positions of the k nearest stations of each point.
+
+        Returns:
+            tuple: arrays of shape (points..., k), or (points...) for k=1. With
+                fewer than k stations, missing neighbours have distance inf and
+                position -1.
+        """
+        chord, found = self.tree.query(lat_lon_to_unit_vectors(lat, lon), k=k, workers=-1)
+        missing = found >= self.positions.size
+        positions = np.where(missing, -1, self.positions[np.minimum(found, self.positions.size - 1)])
+        return np.where(missing, np.inf, chord_to_km(np.where(missing, 0, chord))), positions
+
+    def within_radius(self, lat, lon, radius_km):
+        """Positions of the stations within radius_km of a point, nearest first.
+        For arrays of points, a list with one array per point."""
+        unit = lat_lon_to_unit_vectors(lat, lon)
+        found = self.tree.query_ball_point(unit, r=float(km_to_chord(radius_km)), workers=-1)
+        if unit.ndim == 1:
+            return self._by_distance(unit, found)
+        return [self._by_distance(point, point_found) for point, point_found in
+                zip(unit.reshape(-1, 3), np.asarray(found, dtype=object).ravel())]
+
+    def _by_distance(self, unit, found):
+        found = np.asarray(found, dtype=int)
+        order = np.argsort(np.linalg.norm(self.tree.data[found] - unit, axis=-1), kind='stable')
+        return self.positions[found[order]]
+
+    def within_polygon(self, vertices):
+        """Positions of the stations inside a polygon of (lon, lat) vertices."""
+        inside = points_in_polygon(self.latitudes[self.positions], self.longitudes[self.positions], vertices)
+        return self.positions[inside]
+
+    def pairs_within(self, radius_km):
+        """(m, 2) positions (i < j) of all station pairs within radius_km."""
+        pairs = self.tree.query_pairs(r=float(km_to_chord(radius_km)), output_type='ndarray')
+        return np.sort(self.positions[pairs], axis=1).reshape(-1, 2)
+
+
+def duplicate_stations(latitudes, longitudes, counts, limit_km=1.5):
+    """Stations to reject as duplicates: of every station and its first (lowest
+    index) neighbour within limit_km, the one with fewer valid values is
+    rejected (the station itself on a tie). As in the original distance-matrix
+    loop, distances are haversine distances and stations at exactly the same
+    position are not paired.
+
+    Args:
+        latitudes, longitudes (array-like): station positions.
+        counts (array-like): number of valid values of each station.
+        limit_km (float, optional): duplicate distance. Defaults to 1.5 km.
+
+    Returns:
+        numpy.ndarray: sorted indices of the rejected stations.
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    counts = np.asarray(counts)
+    n = len(counts)
+    # Candidate pairs from the tree, with a margin for rounding, then the distance test of the loop
+    pairs = StationIndex(latitudes, longitudes).pairs_within(limit_km * (1 + 1e-6))
+    distance = haversine((latitudes[pairs[:, 0]], longitudes[pairs[:, 0]]),
+                         (latitudes[pairs[:, 1]], longitudes[pairs[:, 1]]))
+    pairs = pairs[(distance < limit_km * 1000) & (distance != 0)]
+    stations = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    neighbours = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    first = np.full(n, n)
+    np.minimum.at(first, stations, neighbours)
+    has_pair = np.flatnonzero(first < n)
+    partner = first[has_pair]
+    rejected = np.where(counts[has_pair] <= counts[partner], has_pair, partner)
+    return np.unique(rejected)
+
+
+### Streaming GESLA output
+
+# Function to add the single quotes with which the metadata table lists file names
+def _quoted(fname):
+    # Check if fname does not start and end with a single quote
+    if not (fname.startswith("'") and fname.endswith("'")):
+        fname = "'" + fname + "'"
+    return fname
+
+
+class GeslaBlockWriter:
+    """Write GESLA stations to a (station, date_time) NetCDF4 file or Zarr store
+    in blocks, with one metadata variable per column of the metadata table.
+
+    Stations are buffered until block_stations are collected, then written as
+    one block (aligned with the chunks) along the unlimited station dimension.
+    Only one block is held in memory at a time.
+    """
+
+    variables = ["sea_level", "qc_flag", "use_flag"]
+
+    def __init__(self, output_path, date_time, meta, block_stations=64, time_chunk=24 * 365,
+                 compression='zlib'):
+        self.output_path = output_path
+        self.date_time = pd.DatetimeIndex(date_time)
+        self.meta = meta
+        self.block_stations = block_stations
+        self.time_chunk = max(min(time_chunk, len(self.date_time)), 1)
+        self.compression = compression
+        self.zarr = output_path.rstrip('/').endswith('.zarr')
+        self.n_stations = 0
+        self.block = []
+        self.kinds = {column: self._meta_kind(meta[column]) for column in meta.columns}
+        self.nc = None if self.zarr else self._create_netcdf()
+
+    @staticmethod
+    def _meta_kind(values):
+        if pd.api.types.is_datetime64_any_dtype(values) or \
+                values.map(lambda v: isinstance(v, (pd.Timestamp, datetime))).any():
+            return 'datetime'
+        if pd.api.types.is_bool_dtype(values):
+            return 'bool'
+        if pd.api.types.is_numeric_dtype(values):
+            return 'numeric'
+        return 'string'
+
+    def _create_netcdf(self):
+        import netCDF4
+        nc = netCDF4.Dataset(self.output_path, 'w')
+        nc.createDimension('station', None)
+        nc.createDimension('date_time', len(self.date_time))
+        date_time = nc.createVariable('date_time', 'i8', ('date_time',))
+        start = self.date_time[0] if len(self.date_time) else pd.Timestamp(0)
+        date_time.units = f"seconds since {start.strftime('%Y-%m-%d %H:%M:%S')}"
+        date_time.calendar = 'proleptic_gregorian'
+        date_time[:] = ((self.date_time - start) // pd.Timedelta(seconds=1)).values
+        for name in self.variables:
+            nc.createVariable(name, 'f8', ('station', 'date_time'), fill_value=np.nan,
+                              zlib=self.compression == 'zlib', complevel=4, shuffle=True,
+                              chunksizes=(self.block_stations, self.time_chunk))
+        for column in self.meta.columns:
+            kind = self.kinds[column]
+            if kind == 'datetime':
+                variable = nc.createVariable(column, 'f8', ('station',), fill_value=np.nan)
+                variable.units = 'seconds since 1970-01-01 00:00:00'
+                variable.calendar = 'proleptic_gregorian'
+            elif kind == 'bool':
+                nc.createVariable(column, 'i1', ('station',))
+            elif kind == 'numeric':
+                nc.createVariable(column, 'f8', ('station',), fill_value=np.nan)
+            else:
+                nc.createVariable(column, str, ('station',))
+        return nc
+
+    def add(self, data, meta_label):
+        """Queue one station (a file_to_pandas DataFrame on date_time bins) and its
+        metadata row label; the block is written once it is full."""
+        self.block.append((data, meta_label))
+        if len(self.block) >= self.block_stations:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered stations as one block."""
+        if not self.block:
+            return
+        n = len(self.block)
+        with stage_timer('gesla_write_block', items=n) as counts:
+            arrays = {name: np.full((n, len(self.date_time)), np.nan) for name in self.variables}
+            for i, (data, meta_label) in enumerate(self.block):
+                positions = self.date_time.get_indexer(data.index)
+                if (positions < 0).any():
+                    raise ValueError("Station times are not on the resampling bins of the output")
+                for name in self.variables:
+                    arrays[name][i, positions] = data[name].values
+            meta = self.meta.loc[[meta_label for data, meta_label in self.block]]
+            if self.zarr:
+                self._write_zarr_block(arrays, meta)
+            else:
+                self._write_netcdf_block(arrays, meta)
+            counts['bytes'] = sum(array.nbytes for array in arrays.values())
+        self.n_stations += n
+        self.block = []
+
+    def _write_netcdf_block(self, arrays, meta):
+        start, stop = self.n_stations, self.n_stations + len(meta)
+        for name, array in arrays.items():
+            self.nc[name][start:stop, :] = array
+        for column in self.meta.columns:
+            kind = self.kinds[column]
+            values = meta[column]
+            if kind == 'datetime':
+                times = pd.to_datetime(values)
+                seconds = (times - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+                self.nc[column][start:stop] = np.asarray(seconds, dtype=float)
+            elif kind == 'bool':
+                self.nc[column][start:stop] = values.values.astype(np.int8)
+            elif kind == 'numeric':
+                self.nc[column][start:stop] = values.values.astype(float)
+            else:
+                self.nc[column][start:stop] = np.array(['' if pd.isna(v) else str(v) for v in values], dtype=object)
+        self.nc.sync()
+
+    def _write_zarr_block(self, arrays, meta):
+        meta = meta.copy()
+        meta.index = pd.RangeIndex(self.n_stations, self.n_stations + len(meta), name='station')
+        for column in meta.columns:
+            if self.kinds[column] == 'datetime':
+                meta[column] = pd.to_datetime(meta[column])
+            elif self.kinds[column] == 'string':
+                meta[column] = ['' if pd.isna(v) else str(v) for v in meta[column]]
+        block = xr.Dataset({name: (('station', 'date_time'), array) for name, array in arrays.items()},
+                           coords={'date_time': self.date_time})
+        block = block.assign({c: ('station', meta[c].values) for c in meta.columns})
+        if self.n_stations == 0:
+            chunks = (self.block_stations, self.time_chunk)
+            block.to_zarr(self.output_path, mode='w',
+                          encoding={name: {'chunks': chunks} for name in self.variables})
+        else:
+            block.to_zarr(self.output_path, append_dim='station')
+
+    def close(self):
+        """Close the output; call flush first to write the last (partial) block."""
+        if self.nc is not None:
+            self.nc.close()
+            self.nc = None
+
+
+### Parallel GESLA loading
+
+_gesla_worker_state = {}
+
+def _init_gesla_worker(dataset, read_kwargs):
+    """Keep the GeslaDataset (with its metadata table) in the worker process, so
+    that the tasks only carry file names."""
+    _gesla_worker_state['dataset'] = dataset
+    _gesla_worker_state['read_kwargs'] = read_kwargs
+
+
+def _load_gesla_files(task, dataset=None, read_kwargs=None):
+    """Read the files of one task; files with at most one row give None."""
+    dataset = dataset or _gesla_worker_state['dataset']
+    read_kwargs = read_kwargs or _gesla_worker_state['read_kwargs']
+    result = []
+    for f in task['filenames']:
+        outfile = dataset.file_to_pandas(f, **read_kwargs)
+        result.append((f, outfile if len(outfile) > 1 else None))
+    return result
+
+
 class GeslaDataset:
     """A class for loading data from GESLA text files into convenient in-memory
     data objects. By default, single file requests are loaded into
@@ -378,13 +860,19 @@ class GeslaDataset:
     Multifile requests are loaded into `xarray.Dataset` objects, which are
     similar to in-memory NetCDF files."""
 
-    def __init__(self, meta_file, data_path):
+    def __init__(self, meta_file, data_path, cache_dir=None, cache_max_bytes=5 * 1024**3):
         """Initialize loading data from a GESLA database.
 
         Args:
             meta_file (string): path to the metadata file in .csv format.
             data_path (string): path to the directory containing GESLA data
                 files.
+            cache_dir (string, optional): directory where every parsed station
+                is kept as a memory-mappable .npy, so that later reads skip the
+                text parsing. Entries are invalidated when the source file's
+                modification time or size changes. Defaults to None (no cache).
+            cache_max_bytes (int, optional): size cap of the cache; the least
+                recently used stations are evicted above it. Defaults to 5 GB.
         """
         self.meta = pd.read_csv(meta_file)
         self.meta.columns = [
@@ -403,32 +891,84 @@ class GeslaDataset:
         ]
         self.meta.rename(columns={"file_name": "filename"}, inplace=True)
         self.data_path = data_path
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
 
             
+    def _read_file_window(self, path, apply_use_flag, start_date, end_date, resampling, engine):
+        """Parse a GESLA file, restricted to the window from start_date to end_date if given.
+        Returns the data and, when resampling, the first and last kept timestamps
+        of the whole record."""
+        bounds = None
+        with open(path, "rb") as f, stage_timer('gesla_read') as counts:
+            counts['bytes'] = os.path.getsize(path)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if counts['bytes'] else nullcontext(b"") as buffer:
+                lo = _gesla_data_start(buffer)
+                hi = len(buffer)
+                if start_date != None:
+                    # Date-range pushdown: bisect to the window instead of parsing the whole record
+                    first = (start_date - pd.Timedelta(days=1)).strftime(GESLA_DATE_FORMAT).encode()
+                    last = (end_date + pd.Timedelta(days=1)).strftime(GESLA_DATE_FORMAT).encode()
+                    window_lo = _gesla_seek(buffer, lo, hi, first)
+                    window_hi = _gesla_seek(buffer, window_lo, hi, last)
+                    if resampling != None:
+                        # The bins of the full record are kept so that the result matches a full read
+                        bounds = (_gesla_record_bound(buffer, lo, apply_use_flag),
+                                  _gesla_record_bound(buffer, lo, apply_use_flag, last=True))
+                    lo, hi = window_lo, window_hi
+                data = parse_gesla_rows(buffer[lo:hi], engine=engine)
+            counts['items'] = len(data)
+        return data, bounds
+
     def file_to_pandas(self,filename, return_meta=True,apply_use_flag=False,
-                       start_date =None, resampling = None):
+                       start_date =None, resampling = None, engine="numpy", end_date=None):
         """Read a GESLA data file into a pandas.DataFrame object. Metadata is
-        returned as a pandas.Series object.
+        returned as a pandas.Series object. With a cache_dir, the whole file is
+        parsed once and later calls read the cached station instead.
 
         Args:
             filename (string): name of the GESLA data file. Do not prepend path.
             return_meta (bool, optional): determines if metadata is returned as
                 a second function output. Defaults to True.
+            apply_use_flag (bool, optional): keep only rows with use_flag 1.
+                Defaults to False.
+            start_date (datetime, optional): keep only the data after
+                start_date (and before end_date). The file is memory-mapped and
+                only the lines of that window (plus one day on either side) are
+                parsed, since GESLA records are sorted in time. Defaults to None.
+            resampling (str, optional): pandas resampling rule applied before
+                the window is cut. Defaults to None.
+            engine (str, optional): timestamp parser, see parse_gesla_rows.
+                Defaults to 'numpy'.
+            end_date (datetime, optional): end of the window. Defaults to one
+                year after start_date.
 
         Returns:
             pandas.DataFrame: sea-level values and flags with datetime index.
             pandas.Series: record metadata. This return can be excluded by
                 setting return_meta=False.
         """
-        with open(self.data_path + filename, "r") as f:
-            data = pd.read_csv(
-                f,
-                skiprows=41,
-                names=["date", "time", "sea_level", "qc_flag", "use_flag"],
-                sep="\s+",
-                parse_dates=[[0, 1]],
-                index_col=0,
-            )
+        path = self.data_path + filename
+        if start_date != None and end_date is None:
+            end_date = start_date + pd.DateOffset(years=1)
+        if self.cache_dir is not None:
+            with stage_timer('gesla_read') as counts:
+                cache_file = gesla_cache_file(self.cache_dir, path)
+                records = load_cached_station(cache_file)
+                if records is None:
+                    counts['bytes'] = os.path.getsize(path)
+                    with open(path, "rb") as f:
+                        buffer = f.read()
+                    data = parse_gesla_rows(buffer[_gesla_data_start(buffer):], engine=engine)
+                    records = save_cached_station(cache_file, data, max_bytes=self.cache_max_bytes)
+                else:
+                    counts['bytes'] = records.nbytes
+                data, bounds = _select_cached_records(records, start_date, end_date, resampling, apply_use_flag)
+                counts['items'] = len(data)
+        else:
+            data, bounds = self._read_file_window(path, apply_use_flag, start_date, end_date, resampling, engine)
+
+        with stage_timer('gesla_select', items=len(data)):
             duplicates = data.index.duplicated()
             if duplicates.sum() > 0:
                 data = data.loc[~duplicates]
@@ -438,50 +978,158 @@ class GeslaDataset:
 
             if apply_use_flag:
                 data = data[data['use_flag']==1]
-            if resampling != None:
+            if resampling != None and bounds is not None:
+                if bounds[0] is None:
+                    data = data.iloc[:0]
+                else:
+                    bins = pd.Series(0.0, index=pd.DatetimeIndex(bounds)).resample(resampling).mean().index
+                    data = data.resample(resampling, origin=bounds[0].normalize()).mean()
+                    data = data.reindex(bins[(bins > start_date) & (bins < end_date)]).astype(np.float64)
+                    data.index.name = "date_time"
+            elif resampling != None:
                 data = data.resample(resampling).mean()
             if start_date != None:
                 data = data[data.index > start_date]
-                data = data[data.index < start_date+ pd.DateOffset(years=1)]
+                data = data[data.index < end_date]
 
-            if return_meta:
-                meta = self.meta.loc[self.meta.filename == filename].iloc[0]
-                return data, meta
-            else:
-                return data
+        if return_meta:
+            with stage_timer('gesla_meta'):
+                meta = self.meta.loc[self.meta_row(filename)]
+            return data, meta
+        else:
+            return data
+
+    def meta_row(self, filename):
+        """Index label of the metadata row of a file name, from a dict built once
+        per metadata table instead of a scan of self.meta for every file."""
+        if getattr(self, '_meta_index_of', None) is not self.meta:
+            index = {}
+            for label, name in zip(self.meta.index, self.meta['filename']):
+                index.setdefault(name, label)
+            self._meta_index, self._meta_index_of = index, self.meta
+        return self._meta_index[filename]
+
+    def station_index(self):
+        """StationIndex of the metadata table (built once per table)."""
+        if getattr(self, '_station_index_of', None) is not self.meta:
+            self._station_index = StationIndex(self.meta.latitude.values, self.meta.longitude.values)
+            self._station_index_of = self.meta
+        return self._station_index
+
+    def closest_stations(self, latitudes, longitudes, N=1, max_distance_km=None):
+        """Match many points (e.g. altimetry points or grid cells) to their N
+        closest GESLA records in one batched query.
+
+        Args:
+            latitudes (array-like): latitudes of the points.
+            longitudes (array-like): longitudes of the points.
+            N (int, optional): number of records per point. Defaults to 1.
+            max_distance_km (float, optional): drop matches farther than this.
+
+        Returns:
+            pandas.DataFrame: one row per match with the point position, its
+                rank, the metadata index and filename of the record and the
+                great-circle distance in km.
+        """
+        latitudes, longitudes = np.broadcast_arrays(np.atleast_1d(latitudes), np.atleast_1d(longitudes))
+        distances, positions = self.station_index().nearest(latitudes.ravel(), longitudes.ravel(), k=int(N))
+        distances, positions = distances.reshape(-1, int(N)), positions.reshape(-1, int(N))
+        point, rank = np.indices(positions.shape)
+        keep = positions >= 0
+        if max_distance_km is not None:
+            keep &= distances <= max_distance_km
+        return pd.DataFrame({
+            "point": point[keep],
+            "rank": rank[keep],
+            "station": self.meta.index.values[positions[keep]],
+            "filename": self.meta.filename.values[positions[keep]],
+            "distance_km": distances[keep],
+        })
+
+    def _read_files(self, filenames, read_kwargs, on_result, max_workers=None, files_per_task=16):
+        """Read the files in tasks of files_per_task files on a process pool (in
+        this process if max_workers is 1) and call on_result(task, result) as
+        each task finishes, result being (filename, DataFrame or None) pairs.
+        Returns the tasks, in the order of filenames."""
+        tasks = [{'key': f"gesla_files_{start}", 'filenames': list(filenames[start:start + files_per_task])}
+                 for start in range(0, len(filenames), files_per_task)]
+        if max_workers == 1:
+            for task in tasks:
+                on_result(task, _load_gesla_files(task, dataset=self, read_kwargs=read_kwargs))
+        else:
+            run_tiles(_load_gesla_files, tasks, initializer=_init_gesla_worker,
+                      initargs=(self, read_kwargs), max_workers=max_workers,
+                      on_result=on_result, progress=False)
+        return tasks
 
     def files_to_xarray(self, filenames,apply_use_flag=False,
-                       start_date =None, resampling = None):
+                       start_date =None, resampling = None, max_workers=None, files_per_task=16,
+                       end_date=None):
 
         """Read a list of GESLA filenames into a xarray.Dataset object. The
         dataset includes variables containing metadata for each record.
 
+        The files are read by a pool of processes and every station is written
+        straight into preallocated (station, date_time) arrays on the union of
+        the station time axes, so no per-station Dataset is built and concatenated.
+
         Args:
             filenames (list): list of filename strings.
+            apply_use_flag, start_date, resampling, end_date: passed to
+                file_to_pandas.
+            max_workers (int, optional): number of worker processes; 1 reads the
+                files in this process. Defaults to the number of CPUs.
+            files_per_task (int, optional): files read by one task. Defaults to 16.
 
         Returns:
             xarray.Dataset: data, flags, and metadata for each record.
         """
-        files = []
-        act_filenames = []
-        for f in filenames:
-            outfile = self.file_to_pandas(f, return_meta=False,apply_use_flag=apply_use_flag,
-                                              start_date =start_date, resampling = resampling)
-            if len(outfile) > 1:
-                print(f)
-                files.append(outfile.to_xarray())
-                act_filenames.append(f)
-                
-        if len(files) > 0:
-            data = xr.concat(files,dim="station")
-
-            #idx = [s.Index for s in self.meta.itertuples() if s.filename in act_filenames]
+        read_kwargs = dict(return_meta=False, apply_use_flag=apply_use_flag,
+                           start_date=start_date, resampling=resampling, end_date=end_date)
+        loaded = {}
+
+        def keep_loaded(task, result):
+            loaded[task['key']] = result
+
+        tasks = self._read_files(filenames, read_kwargs, keep_loaded, max_workers, files_per_task)
+
+        # Stations with more than one row, in the order of filenames
+        act_filenames, stations = [], []
+        for task in tasks:
+            for f, outfile in loaded.pop(task['key']):
+                if outfile is not None:
+                    print(f)
+                    act_filenames.append(f)
+                    stations.append(outfile)
+
+        if len(stations) > 0:
+            with stage_timer('gesla_concat', items=len(stations)) as counts:
+                date_time = stations[0].index
+                for outfile in stations[1:]:
+                    if not outfile.index.equals(date_time):
+                        date_time = date_time.union(outfile.index)
+                complete = all(len(outfile) == len(date_time) for outfile in stations)
+                columns = list(stations[0].columns)
+                arrays = {c: np.full((len(stations), len(date_time)), np.nan) for c in columns}
+                dtypes = {c: stations[0][c].dtype for c in columns}
+                for i in range(len(stations)):
+                    outfile = stations[i]
+                    positions = date_time.get_indexer(outfile.index)
+                    for c in columns:
+                        arrays[c][i, positions] = outfile[c].values
+                    stations[i] = None  # Release each station once it is copied
+                # Integer flags stay integers when no station needed NaN padding
+                data = xr.Dataset(
+                    {c: (("station", "date_time"), arrays[c].astype(dtypes[c]) if complete else arrays[c])
+                     for c in columns},
+                    coords={"date_time": date_time},
+                )
+                counts['bytes'] = data.nbytes
+
             idx = []
-            for fname in act_filenames:
-                # Check if fname does not start and end with a single quote
-                if not (fname.startswith("'") and fname.endswith("'")):
-                    fname = "'" + fname + "'"
-                idx.append(self.meta[self.meta['filename']==fname].index[0])            
+            with stage_timer('gesla_meta', items=len(act_filenames)):
+                for fname in act_filenames:
+                    idx.append(self.meta_row(_quoted(fname)))
             meta = self.meta.loc[idx]
             meta.index = range(meta.index.size)
             meta.index.name = "station"
@@ -489,6 +1137,61 @@ class GeslaDataset:
             return data            
             
 
+    def files_to_netcdf(self, filenames, output_path, start_date, end_date=None, apply_use_flag=False,
+                        resampling='h', block_stations=64, time_chunk=24 * 365, max_workers=None,
+                        files_per_task=16, compression='zlib'):
+        """Stream a list of GESLA filenames into a chunked (station, date_time)
+        NetCDF4 file, or a Zarr store if output_path ends with '.zarr'.
+
+        Unlike files_to_xarray, the stations are never held together in memory:
+        they are written in blocks of block_stations as the files are read, with
+        their metadata variables, so the memory use does not grow with the number
+        of stations. The time axis is fixed in advance to the resampling bins
+        between start_date and end_date, so resampling is required; stations
+        are stored in the order their files finish reading.
+
+        Args:
+            filenames (list): list of filename strings.
+            output_path (string): path of the .nc file or .zarr store.
+            start_date (datetime): start of the window.
+            end_date (datetime, optional): end of the window. Defaults to one
+                year after start_date.
+            apply_use_flag (bool, optional): passed to file_to_pandas.
+            resampling (str, optional): resampling rule. Defaults to 'h'.
+            block_stations (int, optional): stations per written block and per
+                chunk. Defaults to 64.
+            time_chunk (int, optional): time steps per chunk. Defaults to a year
+                of hours.
+            max_workers, files_per_task: see files_to_xarray.
+            compression (string, optional): 'zlib' or None.
+
+        Returns:
+            int: number of stations written.
+        """
+        if resampling is None:
+            raise ValueError("Streaming needs a resampling rule to fix the time axis in advance")
+        end_date = start_date + pd.DateOffset(years=1) if end_date is None else end_date
+        date_time = pd.date_range(start_date, end_date, freq=resampling)
+        date_time = date_time[(date_time > start_date) & (date_time < end_date)]
+        read_kwargs = dict(return_meta=False, apply_use_flag=apply_use_flag,
+                           start_date=start_date, resampling=resampling, end_date=end_date)
+
+        writer = GeslaBlockWriter(output_path, date_time, self.meta, block_stations=block_stations,
+                                  time_chunk=time_chunk, compression=compression)
+
+        def write_loaded(task, result):
+            for f, outfile in result:
+                if outfile is not None:
+                    print(f)
+                    writer.add(outfile, self.meta_row(_quoted(f)))
+
+        try:
+            self._read_files(filenames, read_kwargs, write_loaded, max_workers, files_per_task)
+            writer.flush()
+        finally:
+            writer.close()
+        return writer.n_stations
+
     def load_N_closest(self, lat, lon, N=1, force_xarray=False):
         """Load the N closest GESLA records to a lat/lon location into a
         xarray.Dataset object. The dataset includes variables containing
@@ -510,9 +1213,9 @@ class GeslaDataset:
         if N <= 0:
             raise Exception("Must specify N > 0")
 
-        d = (self.meta.longitude - lon) ** 2 + (self.meta.latitude - lat) ** 2
-        idx = d.sort_values().iloc[:N].index
-        meta = self.meta.loc[idx]
+        distances, positions = self.station_index().nearest(lat, lon, k=N)
+        positions = np.atleast_1d(positions)
+        meta = self.meta.iloc[positions[positions >= 0]]
 
         if (N > 1) or force_xarray:
             return self.files_to_xarray(meta.filename.tolist())
@@ -551,7 +1254,7 @@ class GeslaDataset:
         Returns:
             xarray.Dataset: data, flags, and metadata for each record.
         """
-        if west_lon > 0 & east_lon < 0:
+        if west_lon > east_lon:  # Range crossing the dateline
             lon_bool = (self.meta.longitude >= west_lon) | (
                 self.meta.longitude <= east_lon
             )
@@ -569,6 +1272,34 @@ class GeslaDataset:
             data, meta = self.file_to_pandas(meta.filename.values[0])
             return data, meta
 
+    def load_within_radius(self, lat, lon, radius_km, force_xarray=False):
+        """Load the GESLA records within radius_km (great-circle) of a lat/lon
+        location, nearest first, into a xarray.Dataset object. As in
+        load_lat_lon_range, a single record is returned as pandas objects
+        unless force_xarray is set."""
+        meta = self.meta.iloc[self.station_index().within_radius(lat, lon, radius_km)]
+
+        if (meta.index.size > 1) or force_xarray:
+            return self.files_to_xarray(meta.filename.tolist())
+
+        else:
+            data, meta = self.file_to_pandas(meta.filename.values[0])
+            return data, meta
+
+    def load_polygon(self, vertices, force_xarray=False):
+        """Load the GESLA records inside a polygon of (lon, lat) vertices (e.g.
+        parallelogram_vertices) into a xarray.Dataset object. As in
+        load_lat_lon_range, a single record is returned as pandas objects
+        unless force_xarray is set."""
+        meta = self.meta.iloc[self.station_index().within_polygon(vertices)]
+
+        if (meta.index.size > 1) or force_xarray:
+            return self.files_to_xarray(meta.filename.tolist())
+
+        else:
+            data, meta = self.file_to_pandas(meta.filename.values[0])
+            return data, meta
+
 def min_lon(phi,min_km):
     lonmin=round(min_km/(((math.cos(phi*(2*3.14/360))*6371)*2)*3.14/360),1)
     return lonmin 
@@ -662,16 +1393,24 @@ def get_dist2coast(add='update'):
     nominal_indexed['dist2coast'][:] = np.concatenate(dists)
     nominal_indexed.to_netcdf('/home/nemo/work_julius/S6_JTEX/data/S6_20Hz_dist2coast_indexed'+add+'.nc')    
     
-def make_gesla(start_date = pd.to_datetime('01-01-2021'),add='update'):
+def make_gesla(start_date = pd.to_datetime('01-01-2021'),add='update',
+               cache_dir=None, end_date=None, streaming=True):
     dire = '/nfs/DGFI8/D/tide-gauges/GESLA_3/'
     #filenames = os.listdir(dire)
     meta = '/nfs/DGFI8/D/tide-gauges/GESLA_3_meta/GESLA3_ALL_2.csv'    
-    gesla = GeslaDataset(meta,dire)
+    gesla = GeslaDataset(meta,dire,cache_dir=cache_dir)
     #filenames = gesla.meta[gesla.meta['end_date_time'] > pd.to_datetime('31-12-2021')].filename.values
     filenames = gesla.meta.filename.values
-    gesla_all = gesla.files_to_xarray(filenames = filenames,apply_use_flag=True,
-                       start_date =start_date, resampling = 'H')
-    gesla_all.to_netcdf('/nfs/public_ads/Oelsmann/marcello/gesla_v3/gesla_2021'+add+'.nc')
+    output_file = '/nfs/public_ads/Oelsmann/marcello/gesla_v3/gesla_2021'+add+'.nc'
+    if streaming:
+        # Stations are written block by block, so multi-year windows fit in memory
+        gesla.files_to_netcdf(filenames, output_file, start_date, end_date=end_date,
+                              apply_use_flag=True, resampling = 'H')
+    else:
+        gesla_all = gesla.files_to_xarray(filenames = filenames,apply_use_flag=True,
+                           start_date =start_date, resampling = 'H', end_date=end_date)
+        gesla_all.to_netcdf(output_file)
+    write_metrics_summary('/nfs/public_ads/Oelsmann/marcello/gesla_v3/gesla_2021'+add+'_metrics')
 
     
 def select_and_dropdupl(add='update_northsea4'):
@@ -679,24 +1418,9 @@ def select_and_dropdupl(add='update_northsea4'):
     gesla_all_sorted = gesla_all.sortby('site_name')
     limit = 1500
     counts = gesla_all_sorted['sea_level'].count(dim='date_time').values
-    coords =np.stack([gesla_all_sorted.latitude.values,gesla_all_sorted.longitude.values])
-    distancs = []
-    for coord1 in coords.T:
-        distancs.append(haversine(coord1, coords))
-    distancs = np.vstack(distancs)
-    pairs = []
-    reject_indices = []
-    for i in range(distancs.shape[0]):
-        sub = distancs[:,i]
-        idx = np.argwhere(   (sub<limit) & (sub!=0) ) 
-        if len(idx)>0:
-            pairs.append([i,idx[0]])
-            if counts[i]<=counts[int(idx[0])]:
-                reject_indices.append(i)
-            else:
-                reject_indices.append(int(idx[0]))
-    reject_at  = pd.DataFrame(reject_indices).drop_duplicates().values.flatten()
-    gesla_selected = gesla_all_sorted.sel({'station':~np.isin(np.arange(distancs.shape[0]),reject_at)})
+    reject_at = duplicate_stations(gesla_all_sorted.latitude.values, gesla_all_sorted.longitude.values,
+                                   counts, limit_km=limit / 1000)
+    gesla_selected = gesla_all_sorted.sel({'station':~np.isin(np.arange(len(counts)),reject_at)})
     mask = (gesla_selected['date_time'].to_dataframe()['date_time'] >  pd.to_datetime('04-15-2021')).values
     counts_after_april = gesla_selected.sel({'date_time':mask}).count(dim='date_time')['sea_level']
     gesla_selected_final = gesla_selected.where(counts_after_april > 1,drop=True)
@@ -779,7 +1503,7 @@ def select_tracks(nominal_track,gesla,station = 0):
     return tracks_sel,coord1
 
 def haversine(coord1, coord2):
-    R = 6372800  # Earth radius in meters
+    R = EARTH_RADIUS_KM * 1000  # Earth radius in meters
     lat1, lon1 = coord1
     lat2, lon2 = coord2
 
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+import os
+import json
+import time
+import contextlib
+import threading
+from datetime import datetime
+import hashlib
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+
+# Helpers shared by the altimetry (ctw_functions.py), GESLA (gesla_functions.py) and
+# detiding (detiding_functions.py) modules: run keys, stage metrics, the process pool
+# over shared memory, size-bounded on-disk caches and point-in-polygon tests
+
+### Run keys
+
+def run_key(**params):
+    """Hash the parameters that define a run (case, dates, band, inputs, ...)."""
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+### Run metrics
+
+# Seconds, calls, items and bytes of each processing stage, accumulated in this process
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def add_metric(stage, seconds=0.0, items=0, nbytes=0, calls=1):
+    """Add one or more calls of a stage to the metrics of this process."""
+    with _metrics_lock:
+        entry = _metrics.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'items': 0, 'bytes': 0})
+        entry['seconds'] += seconds
+        entry['calls'] += calls
+        entry['items'] += items
+        entry['bytes'] += nbytes
+
+@contextlib.contextmanager
+def stage_timer(stage, items=0, nbytes=0):
+    """Time a block of code as one call of `stage`.
+
+    The counts can also be set inside the block, once they are known:
+
+        with stage_timer('read') as counts:
+            data = read()
+            counts['items'] = len(data)
+    """
+    counts = {'items': items, 'bytes': nbytes}
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        add_metric(stage, time.perf_counter() - start, counts['items'], counts['bytes'])
+
+def get_metrics():
+    """Copy of the metrics of this process."""
+    with _metrics_lock:
+        return {stage: dict(entry) for stage, entry in _metrics.items()}
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+def merge_metrics(metrics):
+    """Add metrics collected elsewhere, e.g. in a worker process."""
+    for stage, entry in metrics.items():
+        add_metric(stage, entry['seconds'], entry['items'], entry['bytes'], entry['calls'])
+
+def _metrics_since(before):
+    after = get_metrics()
+    empty = {'seconds': 0.0, 'calls': 0, 'items': 0, 'bytes': 0}
+    difference = {stage: {name: entry[name] - before.get(stage, empty)[name] for name in entry}
+                  for stage, entry in after.items()}
+    return {stage: entry for stage, entry in difference.items() if entry['calls'] > 0}
+
+@contextlib.contextmanager
+def profiled(name):
+    """Profile a block with cProfile if the CTW_PROFILE_DIR environment variable is set.
+
+    The statistics are dumped to CTW_PROFILE_DIR/<name>_<pid>_<n>.prof, one file
+    per block and process; combine them with pstats.Stats(*files).
+    """
+    profile_dir = os.environ.get('CTW_PROFILE_DIR')
+    if not profile_dir:
+        yield
+        return
+
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        count = len([f for f in os.listdir(profile_dir) if f.startswith(f"{name}_{os.getpid()}_")])
+        profile.dump_stats(os.path.join(profile_dir, f"{name}_{os.getpid()}_{count}.prof"))
+
+def call_with_metrics(func, *args, **kwargs):
+    """Run `func` (in a worker process) and return its result with the metrics it added.
+
+    Used by `run_tiles` and `BackgroundWriter` to bring the metrics of the worker
+    processes back to the main process.
+    """
+    before = get_metrics()
+    with profiled(getattr(func, '__name__', 'task')):
+        result = func(*args, **kwargs)
+    return result, _metrics_since(before)
+
+def write_netcdf(dataset, output_path, stage='write', **kwargs):
+    """`dataset.to_netcdf(output_path, **kwargs)`, recorded as a call of `stage` with the written bytes."""
+    with stage_timer(stage, items=1) as counts:
+        dataset.to_netcdf(output_path, **kwargs)
+        counts['bytes'] = os.path.getsize(output_path)
+
+def metrics_summary(metrics=None, wall_seconds=None):
+    """Table of the stages with their share of the time and their throughput.
+
+    Seconds are summed over all processes and threads, so with parallel
+    workers the total can exceed the wall time.
+
+    Returns:
+        pandas.DataFrame: one row per stage, slowest first.
+    """
+    metrics = get_metrics() if metrics is None else metrics
+    summary = pd.DataFrame.from_dict(metrics, orient='index',
+                                     columns=['seconds', 'calls', 'items', 'bytes'])
+    summary.index.name = 'stage'
+    seconds = summary['seconds'].where(summary['seconds'] > 0)
+    summary['share'] = summary['seconds'] / summary['seconds'].sum() if len(summary) else []
+    summary['ms_per_call'] = 1e3 * summary['seconds'] / summary['calls']
+    summary['items_per_s'] = summary['items'] / seconds
+    summary['mb_per_s'] = summary['bytes'] / 1e6 / seconds
+    if wall_seconds:
+        summary['wall_share'] = summary['seconds'] / wall_seconds
+    return summary.sort_values('seconds', ascending=False)
+
+def write_metrics_summary(output_prefix, metrics=None, wall_seconds=None, params=None):
+    """Write the metrics of a run to <output_prefix>.json and <output_prefix>.csv.
+
+    Args:
+        output_prefix (string): path of the output files, without extension.
+        metrics (dict, optional): metrics to write. Defaults to the metrics of this process.
+        wall_seconds (float, optional): wall time of the run.
+        params (dict, optional): run parameters stored in the JSON file.
+    """
+    summary = metrics_summary(metrics, wall_seconds)
+    summary.to_csv(output_prefix + '.csv')
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'wall_seconds': wall_seconds,
+        'params': params,
+        'stages': json.loads(summary.to_json(orient='index')),
+    }
+    with open(output_prefix + '.json', 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+    print(f"Saved run metrics to {output_prefix}.json")
+    return summary
+
+### Process pool
+
+def share_array(array):
+    """Copy an array into a new shared memory block.
+
+    Returns:
+        shm (multiprocessing.shared_memory.SharedMemory): the block; the caller
+            closes and unlinks it when the workers are done.
+        ref (tuple): (name, shape, dtype), picklable reference for `attach_shared_array`.
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_shared_array(ref):
+    """Attach to an array shared with `share_array`, without copying it.
+
+    Returns:
+        shm, numpy.ndarray: keep `shm` referenced as long as the array is used.
+    """
+    name, shape, dtype = ref
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def run_tiles(worker, tiles, initializer=None, initargs=(), max_workers=None, max_in_flight=None,
+              on_result=None, progress=True):
+    """Run `worker(tile)` for every tile on a process pool with a bounded number of tasks in flight.
+
+    Large inputs are not passed with each task: give them to `initializer`,
+    which runs once per worker process (e.g. to attach shared arrays). The
+    stage metrics recorded by the workers are added to those of the main process.
+
+    Args:
+        worker (callable): function processing one tile, must be picklable.
+        tiles (list): dicts with the 'key' and the 'points' of each tile, e.g.
+            from `make_tiles` in ctw_functions.py.
+        initializer (callable, optional): called with `initargs` in every worker.
+        max_workers (int, optional): number of worker processes. Defaults to
+            the number of CPUs.
+        max_in_flight (int, optional): maximum number of submitted, unfinished
+            tasks. Defaults to twice the number of workers.
+        on_result (callable, optional): called as `on_result(tile, result)` in
+            the main process as soon as a tile is done.
+        progress (bool, optional): print a line per finished tile.
+    """
+    max_workers = max_workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * max_workers
+    tiles_iter = iter(tiles)
+    n_done = 0
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs) as executor:
+        pending = {}
+        while True:
+            # Keep the pool busy without queueing every tile at once
+            while len(pending) < max_in_flight:
+                tile = next(tiles_iter, None)
+                if tile is None:
+                    break
+                pending[executor.submit(call_with_metrics, worker, tile)] = tile
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile = pending.pop(future)
+                result, metrics = future.result()
+                merge_metrics(metrics)  # Stage metrics of the worker process
+                n_done += 1
+                if on_result is not None:
+                    on_result(tile, result)
+                if progress:
+                    print(f"Finished {tile['key']} ({len(tile['points'])} points), {n_done}/{len(tiles)} tiles")
+
+### On-disk cache
+
+def save_cache_entry(cache_dir, entry, savers, max_bytes, prefix):
+    """Write one entry of a size-bounded cache directory, then evict the least
+    recently used entries until the cache is below `max_bytes`.
+
+    Args:
+        cache_dir (string): cache directory, created if needed.
+        entry (string): name of the entry, starting with `prefix`; its files are
+            named `<entry><suffix>`, e.g. 'cube_<key>.npy' and 'cube_<key>.coords.npz'.
+        savers (dict): function writing each file to the path it is given, by suffix.
+        max_bytes (int): size cap of the entries starting with `prefix`.
+        prefix (string): file name prefix of the entries of this cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    for suffix, save in savers.items():
+        # Write to a temporary file first, so that a killed run never leaves a partial entry
+        cache_file = os.path.join(cache_dir, entry + suffix)
+        tmp_file = os.path.join(cache_dir, f"{entry}.tmp{os.getpid()}{suffix}")
+        try:
+            save(tmp_file)
+            os.replace(tmp_file, cache_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    evict_cache_entries(cache_dir, max_bytes, prefix, keep=entry)
+
+def evict_cache_entries(cache_dir, max_bytes, prefix, keep=None):
+    """Remove the least recently used entries starting with `prefix` until they are below `max_bytes`.
+
+    The files of an entry share the name before the first dot, and an entry was
+    last used when any of its files was last modified (loaders touch them).
+    """
+    entries = {}
+    for file_name in os.listdir(cache_dir):
+        if not file_name.startswith(prefix) or '.tmp' in file_name:
+            continue
+        cache_file = os.path.join(cache_dir, file_name)
+        try:
+            last_used, size = os.path.getmtime(cache_file), os.path.getsize(cache_file)
+        except FileNotFoundError:  # Evicted meanwhile by another process
+            continue
+        entry = entries.setdefault(file_name.split('.')[0], {'last_used': 0.0, 'size': 0, 'files': []})
+        entry['last_used'] = max(entry['last_used'], last_used)
+        entry['size'] += size
+        entry['files'].append(cache_file)
+
+    total = sum(entry['size'] for entry in entries.values())
+    for name, entry in sorted(entries.items(), key=lambda item: item[1]['last_used']):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        for cache_file in entry['files']:
+            try:
+                os.remove(cache_file)
+            except FileNotFoundError:
+                pass
+        total -= entry['size']
+
+### Geometry
+
+def points_in_polygon(latitudes, longitudes, vertices):
+    """Boolean mask of the points (latitudes[i], longitudes[i]) inside a polygon.
+
+    Args:
+        vertices (array-like): (n, 2) polygon vertices as (lon, lat), like
+            parallelogram_vertices. Points on the polygon edges are inside.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    lat_grid = np.asarray(latitudes, dtype=float)
+    lon_grid = np.asarray(longitudes, dtype=float)
+    inside = np.zeros(lat_grid.shape, dtype=bool)
+    on_edge = np.zeros(lat_grid.shape, dtype=bool)
+
+    # Even-odd ray casting, one polygon edge at a time over all points
+    for (x1, y1), (x2, y2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        crosses = (y1 > lat_grid) != (y2 > lat_grid)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (lat_grid - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (lon_grid < x_cross)
+
+        # Points on the edge segment
+        cross_product = (x2 - x1) * (lat_grid - y1) - (y2 - y1) * (lon_grid - x1)
+        within = ((lon_grid >= min(x1, x2) - 1e-9) & (lon_grid <= max(x1, x2) + 1e-9) &
+                  (lat_grid >= min(y1, y2) - 1e-9) & (lat_grid <= max(y1, y2) + 1e-9))
+        on_edge |= within & (abs(cross_product) < 1e-9)
+
+    return inside | on_edge
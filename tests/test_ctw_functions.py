@@ -0,0 +1,209 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from ctw_functions import interpolate_nan, interpolate_nan_columns, butter_bandpass_filter
+from ctw_functions import butter_bandpass_filter_matrix, butter_bandpass_filter_bands
+from ctw_functions import find_nearest_non_nan, fill_nan_from_nearest, fill_and_filter_lazy, polygon_mask
+from ctw_functions import BackgroundWriter, scatter_series_to_cube, place_series_in_grid
+from ctw_functions import save_cached_cube, load_cached_cube
+
+
+@pytest.fixture
+def gappy_matrix():
+    """(time, points) matrix with random gaps, empty columns and gaps at both ends."""
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((94, 50))
+    data[rng.random(data.shape) < 0.3] = np.nan
+    data[:, 3] = np.nan
+    data[:5, 4] = np.nan
+    data[-7:, 5] = np.nan
+    data[:, 6] = np.nan
+    data[40, 6] = 1.0
+    data[:, 7] = np.nan
+    data[:5, 7] = 0.5  # Above the NaN threshold
+    return data
+
+
+def test_interpolate_nan_columns_matches_per_column(gappy_matrix):
+    interpolated = interpolate_nan_columns(gappy_matrix)
+    for column in range(gappy_matrix.shape[1]):
+        series = gappy_matrix[:, column].copy()
+        if np.isnan(series).all():
+            assert np.isnan(interpolated[:, column]).all()
+        else:
+            np.testing.assert_allclose(interpolated[:, column], interpolate_nan(series))
+
+
+def test_butter_bandpass_filter_matrix_matches_per_column(gappy_matrix):
+    lowcut, highcut, fs = 0.035, 0.15, 1.0
+    filtered, nan_fraction = butter_bandpass_filter_matrix(gappy_matrix, lowcut, highcut, fs)
+    for column in range(gappy_matrix.shape[1]):
+        series = gappy_matrix[:, column].copy()
+        assert nan_fraction[column] == pytest.approx(np.isnan(series).mean())
+        if np.isnan(series).sum() <= 0.9 * len(series):
+            expected = butter_bandpass_filter(interpolate_nan(series), lowcut, highcut, fs, order=5)
+            np.testing.assert_allclose(filtered[:, column], expected, atol=1e-12)
+        else:
+            assert np.isnan(filtered[:, column]).all()
+
+
+def test_butter_bandpass_filter_bands_matches_single_band(gappy_matrix):
+    bands = [(0.035, 0.15, 5), (0.01, 0.05, 4)]
+    filtered, _ = butter_bandpass_filter_bands(gappy_matrix, bands, 1.0)
+    for band, (lowcut, highcut, order) in enumerate(bands):
+        expected, _ = butter_bandpass_filter_matrix(gappy_matrix, lowcut, highcut, 1.0, order=order)
+        np.testing.assert_array_equal(filtered[band], expected)
+
+
+@pytest.mark.filterwarnings('ignore::FutureWarning')
+def test_fill_nan_from_nearest_matches_ring_scan():
+    rng = np.random.default_rng(2)
+    cube = rng.standard_normal((3, 12, 20))
+    land = np.zeros((12, 20), dtype=bool)
+    land[:, 13:] = True  # Coast with cells beyond max_radius
+    land[5:7, 3:6] = True
+    cube[:, land] = np.nan
+    cube[1, rng.random((12, 20)) < 0.1] = np.nan
+    cube[2, rng.random((12, 20)) < 0.3] = np.nan
+
+    filled = fill_nan_from_nearest(cube, 'TEST')
+    for day in range(cube.shape[0]):
+        dataset = xr.Dataset({'sla': (['latitude', 'longitude'], cube[day])})
+        for lat_idx, lon_idx in zip(*np.nonzero(np.isnan(cube[day]))):
+            expected = find_nearest_non_nan(dataset, lat_idx, lon_idx)
+            np.testing.assert_equal(filled[day, lat_idx, lon_idx], expected)
+    np.testing.assert_equal(filled[~np.isnan(cube)], cube[~np.isnan(cube)])
+
+
+@pytest.mark.parametrize('space_chunk', [5, 8, 64])
+def test_fill_and_filter_lazy_matches_eager(space_chunk):
+    pytest.importorskip('dask')
+    rng = np.random.default_rng(3)
+    cube = rng.standard_normal((40, 17, 23))
+    land = np.zeros((17, 23), dtype=bool)
+    land[:, 15:] = True
+    land[6:9, 3:7] = True
+    cube[:, land] = np.nan
+    cube[5, rng.random((17, 23)) < 0.2] = np.nan
+    bands = [(0.035, 0.15, 5)]
+
+    sla = xr.DataArray(cube, dims=('time', 'latitude', 'longitude'),
+                       coords={'time': pd.date_range('2023-08-29', periods=40)})
+    sla = sla.chunk({'time': -1, 'latitude': space_chunk, 'longitude': space_chunk})
+    filled, filtered = fill_and_filter_lazy(sla, bands, 1.0, 'TEST')
+
+    expected = fill_nan_from_nearest(cube, 'TEST')
+    np.testing.assert_array_equal(filled.values, expected)
+    expected_filtered, _ = butter_bandpass_filter_bands(expected.reshape(40, -1), bands, 1.0)
+    np.testing.assert_allclose(filtered.values, expected_filtered.reshape(1, 40, 17, 23), atol=1e-12)
+
+
+def test_fill_and_filter_lazy_keeps_nearest_index_in_cache_dir(tmp_path):
+    pytest.importorskip('dask')
+    cube = np.random.default_rng(4).standard_normal((40, 12, 12))
+    cube[:, :, 9:] = np.nan
+    sla = xr.DataArray(cube, dims=('time', 'latitude', 'longitude')).chunk({'latitude': 6, 'longitude': 6})
+    filled, _ = fill_and_filter_lazy(sla, [(0.035, 0.15, 5)], 1.0, 'TEST_CACHE', cache_dir=str(tmp_path))
+
+    np.testing.assert_array_equal(filled.values, fill_nan_from_nearest(cube, 'TEST'))
+    assert list(tmp_path.glob('nearest_valid_ring_TEST_CACHE_*.npz'))
+
+
+def test_fill_and_filter_lazy_rejects_chunks_below_max_radius():
+    pytest.importorskip('dask')
+    sla = xr.DataArray(np.zeros((40, 12, 12)), dims=('time', 'latitude', 'longitude')).chunk({'latitude': 3})
+    with pytest.raises(ValueError):
+        fill_and_filter_lazy(sla, [(0.035, 0.15, 5)], 1.0, 'TEST', max_radius=5)
+
+
+def is_inside_parallelogram(lat, lon, vertices):
+    """Point test of the original create_filtered_grids.py, kept as the reference of polygon_mask."""
+    if lon < np.min(vertices[:, 0]) or lon > np.max(vertices[:, 0]):
+        return False
+    if lat < np.min(vertices[:, 1]) or lat > np.max(vertices[:, 1]):
+        return False
+    return True
+
+
+def test_polygon_mask_matches_is_inside_parallelogram():
+    vertices = np.array([[149, -38], [158, -38], [158, -25], [149, -25]])
+    latitudes = np.arange(-40, -22, 0.125)  # Includes cells on the edges and the corners
+    longitudes = np.arange(147, 160, 0.25)
+    mask = polygon_mask(latitudes, longitudes, vertices)
+    expected = np.array([[is_inside_parallelogram(lat, lon, vertices) for lon in longitudes] for lat in latitudes])
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_background_writer_flush_waits_for_on_done():
+    done = []
+
+    def slow_on_done(k):
+        time.sleep(0.05)
+        done.append(k)
+
+    def fail():
+        raise OSError("disk full")
+
+    with BackgroundWriter(n_writers=2, max_queue=4) as writer:
+        for k in range(8):
+            writer.submit(lambda: None, on_done=lambda k=k: slow_on_done(k))
+        writer.flush()
+        assert sorted(done) == list(range(8))
+
+        writer.submit(fail)
+        with pytest.raises(OSError):
+            writer.flush()
+        writer.flush()  # The error is reported once
+
+
+def test_scatter_series_to_cube_matches_per_sample_assignment():
+    rng = np.random.default_rng(4)
+    time_range = pd.date_range('2023-08-29', periods=10)
+    latitudes, longitudes = np.arange(-38, -35, 0.25), np.arange(149, 152, 0.25)
+    # Points on the grid, one off the grid, and series with different and partly outside time axes
+    point_lat = np.append(rng.choice(latitudes, 6), -30.0)
+    point_lon = np.append(rng.choice(longitudes, 6), 150.0)
+    point_times = [pd.date_range('2023-08-27', periods=8).values] * 4 + \
+                  [pd.date_range('2023-09-03', periods=6).values, time_range[::2].values, time_range.values]
+    point_series = [rng.standard_normal(len(times)) for times in point_times]
+
+    cube = scatter_series_to_cube(time_range, latitudes, longitudes, point_times, point_lat, point_lon, point_series)
+    expected = np.full(cube.shape, np.nan)
+    for lat, lon, times, series in zip(point_lat, point_lon, point_times, point_series):
+        for time, value in zip(times, series):
+            if lat in latitudes and lon in longitudes and time in time_range:
+                expected[time_range.get_loc(time), np.flatnonzero(latitudes == lat)[0],
+                         np.flatnonzero(longitudes == lon)[0]] = value
+    np.testing.assert_array_equal(cube, expected)
+
+    shared = place_series_in_grid(time_range, latitudes, longitudes, point_times[0], point_lat[:4], point_lon[:4],
+                                  np.stack(point_series[:4], axis=1))
+    np.testing.assert_array_equal(shared, scatter_series_to_cube(time_range, latitudes, longitudes, point_times[:4],
+                                                                 point_lat[:4], point_lon[:4], point_series[:4]))
+
+
+def test_cube_cache_evicts_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path)
+    times = pd.date_range('2023-08-29', periods=10)
+    latitudes, longitudes = np.arange(4.0), np.arange(5.0)
+    cubes = {key: np.full((10, 4, 5), value) for value, key in enumerate(['a', 'b', 'c'])}
+    save_cached_cube(cache_dir, 'a', times, latitudes, longitudes, cubes['a'])
+    save_cached_cube(cache_dir, 'b', times, latitudes, longitudes, cubes['b'])
+    for last_used, key in [(1e9, 'b'), (2e9, 'a')]:  # 'a' used more recently than 'b'
+        for path in tmp_path.glob(f'cube_{key}.*'):
+            os.utime(path, (last_used, last_used))
+    entry_bytes = sum(path.stat().st_size for path in tmp_path.glob('cube_a.*'))
+    save_cached_cube(cache_dir, 'c', times, latitudes, longitudes, cubes['c'], max_bytes=2 * entry_bytes)
+
+    assert load_cached_cube(cache_dir, 'b') is None
+    for key in ['a', 'c']:
+        cached_times, cached_latitudes, _, cube = load_cached_cube(cache_dir, key)
+        np.testing.assert_array_equal(cached_times, times)
+        np.testing.assert_array_equal(cube, cubes[key])
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'cube_a.coords.npz', 'cube_a.npy', 'cube_c.coords.npz', 'cube_c.npy']
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from detiding_functions import lowess_smooth, lowess_stations, tidal_filter
+
+
+def hourly_series(rng, n_hours=2000):
+    """Tides, a slow signal and noise, with random and long gaps."""
+    hours = np.arange(n_hours)
+    series = (0.5 * np.sin(2 * np.pi * hours / 12.42) + 0.2 * np.sin(2 * np.pi * hours / 24)
+              + 0.1 * np.sin(2 * np.pi * hours / 300) + 0.05 * rng.standard_normal(n_hours))
+    series[rng.random(n_hours) < 0.05] = np.nan
+    series[500:650] = np.nan
+    return series
+
+
+@pytest.mark.parametrize('frac, delta', [(40 / 2000, 0.0), (40 / 2000, 3.0), (0.3, 0.0), (0.3, 10.0)])
+def test_lowess_smooth_matches_statsmodels(frac, delta):
+    statsmodels = pytest.importorskip('statsmodels.api')
+    series = hourly_series(np.random.default_rng(2))
+    hours = np.arange(len(series))
+    expected = statsmodels.nonparametric.lowess(series, hours, frac=frac, delta=delta)
+
+    smoothed = lowess_smooth(series, frac=frac, delta=delta)
+    valid = np.isfinite(series)
+    np.testing.assert_array_equal(hours[valid], expected[:, 0])
+    np.testing.assert_allclose(smoothed[valid], expected[:, 1], atol=1e-10)
+    assert np.isnan(smoothed[~valid]).all()
+
+
+def test_lowess_stations_matches_lowess_smooth():
+    rng = np.random.default_rng(3)
+    data = np.stack([hourly_series(rng, 500) for _ in range(5)])
+    data[3] = np.nan
+    data[4, 1:] = np.nan
+    smoothed = lowess_stations(data, 0.1, max_workers=2, stations_per_task=2)
+    for station in range(len(data)):
+        np.testing.assert_array_equal(smoothed[station], lowess_smooth(data[station], frac=0.1))
+
+
+@pytest.mark.parametrize('method', ['godin', 'doodson'])
+def test_tidal_filter_removes_the_tides(method):
+    hours = np.arange(24 * 60)
+    slow = 0.1 * np.sin(2 * np.pi * hours / (24 * 20))
+    series = slow + 0.5 * np.sin(2 * np.pi * hours / 12.42) + 0.2 * np.sin(2 * np.pi * hours / 23.93)
+    filtered = tidal_filter(series[None], method=method)[0]
+    covered = np.isfinite(filtered)
+    assert covered[100:-100].all()
+    np.testing.assert_allclose(filtered[covered], slow[covered], atol=0.02)
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from gesla_functions import GeslaDataset, GESLA_COLUMNS, GESLA_HEADER_LINES, GESLA_DATE_FORMAT
+from gesla_functions import EARTH_RADIUS_KM, haversine, duplicate_stations
+
+
+def write_gesla_file(path, start, end, freq='h', gap=None, seed=0):
+    """Write a GESLA-formatted file with duplicated timestamps and random flags."""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, end, freq=freq)
+    if gap is not None:
+        times = times[(times < gap[0]) | (times > gap[1])]
+    times = times.append(times[rng.integers(0, len(times), 5)]).sort_values()
+    with open(path, 'w') as f:
+        for i in range(GESLA_HEADER_LINES):
+            f.write(f"# header line {i}\n")
+        for time, sea_level, qc_flag, use_flag in zip(times, rng.normal(size=len(times)),
+                                                      rng.integers(0, 3, len(times)),
+                                                      (rng.random(len(times)) > 0.1).astype(int)):
+            f.write(f"{time.strftime(GESLA_DATE_FORMAT)} {sea_level:10.4f} {qc_flag} {use_flag}\n")
+
+
+def read_full(path, apply_use_flag, start_date, resampling):
+    """Whole-file read and selection of the original file_to_pandas."""
+    data = pd.read_csv(path, skiprows=GESLA_HEADER_LINES, names=GESLA_COLUMNS, sep=r"\s+")
+    dates = pd.to_datetime(data.pop('date') + ' ' + data.pop('time'), format=GESLA_DATE_FORMAT)
+    data.index = pd.DatetimeIndex(dates).as_unit('ns')
+    data.index.name = 'date_time'
+    data = data.loc[~data.index.duplicated()]
+    if apply_use_flag:
+        data = data[data['use_flag'] == 1]
+    if resampling is not None:
+        data = data.resample(resampling).mean()
+    if start_date is not None:
+        data = data[data.index > start_date]
+        data = data[data.index < start_date + pd.DateOffset(years=1)]
+    return data
+
+
+@pytest.fixture(scope='module')
+def gesla_dir(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp('gesla')
+    write_gesla_file(tmp_path / 'long', '2019-03-01', '2023-02-01 06:00', seed=1)
+    write_gesla_file(tmp_path / 'gap', '2020-06-01', '2022-03-01', gap=('2020-12-20', '2021-01-10'), seed=2)
+    write_gesla_file(tmp_path / 'before', '2015-01-01', '2018-01-01', seed=3)
+    write_gesla_file(tmp_path / 'offset', '2021-02-01 00:07', '2021-03-01', freq='7min', seed=4)
+    return tmp_path
+
+
+def gesla_dataset(data_path, cache_dir=None):
+    """GeslaDataset on a directory of files, without a metadata file."""
+    dataset = object.__new__(GeslaDataset)
+    dataset.data_path = str(data_path) + '/'
+    dataset.meta = pd.DataFrame({'filename': ['long', 'gap', 'before', 'offset']})
+    dataset.cache_dir = cache_dir
+    dataset.cache_max_bytes = 5 * 1024**3
+    return dataset
+
+
+@pytest.mark.filterwarnings('ignore:Duplicate timestamps')
+@pytest.mark.parametrize('engine', ['numpy', 'pandas'])
+@pytest.mark.parametrize('resampling', [None, 'h', '3h'])
+@pytest.mark.parametrize('apply_use_flag', [False, True])
+@pytest.mark.parametrize('start_date', [None, pd.Timestamp('2021-01-01')])
+def test_window_read_matches_full_read(gesla_dir, engine, resampling, apply_use_flag, start_date):
+    dataset = gesla_dataset(gesla_dir)
+    for filename in dataset.meta.filename:
+        data = dataset.file_to_pandas(filename, return_meta=False, apply_use_flag=apply_use_flag,
+                                      start_date=start_date, resampling=resampling, engine=engine)
+        expected = read_full(gesla_dir / filename, apply_use_flag, start_date, resampling)
+        pd.testing.assert_frame_equal(data, expected, check_freq=False)
+
+
+@pytest.mark.filterwarnings('ignore:Duplicate timestamps')
+def test_cache_separates_directories_with_the_same_file_names(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    data = {}
+    for name, seed in [('release_a', 1), ('release_b', 2)]:
+        os.makedirs(tmp_path / name)
+        write_gesla_file(tmp_path / name / 'station', '2021-01-01', '2021-02-01', seed=seed)
+        os.utime(tmp_path / name / 'station', (1.6e9, 1.6e9))  # Same name, size and modification time
+        for repeat in range(2):  # Parsed, then read from the cache
+            data[name, repeat] = gesla_dataset(tmp_path / name, cache_dir).file_to_pandas('station', return_meta=False)
+        expected = read_full(tmp_path / name / 'station', False, None, None)
+        pd.testing.assert_frame_equal(data[name, 1], expected, check_freq=False)
+    assert not data['release_a', 1].equals(data['release_b', 1])
+
+
+def duplicate_stations_loop(latitudes, longitudes, counts, limit=1500):
+    """Distance-matrix loop of the original select_and_dropdupl (limit in m)."""
+    coords = np.stack([latitudes, longitudes])
+    distances = np.vstack([haversine(coord, coords) for coord in coords.T])
+    reject_at = []
+    for i in range(len(counts)):
+        sub = distances[:, i]
+        idx = np.argwhere((sub < limit) & (sub != 0))
+        if len(idx) > 0:
+            first = int(idx[0, 0])
+            reject_at.append(i if counts[i] <= counts[first] else first)
+    return np.unique(reject_at)
+
+
+def test_duplicate_stations_matches_distance_loop():
+    rng = np.random.default_rng(3)
+    n_base = 300
+    base_lat, base_lon = rng.uniform(-60, 70, n_base), rng.uniform(-180, 180, n_base)
+    # Neighbours within a few km, pairs just inside and outside 1.5 km, and co-located stations
+    boundary = np.array([1499.9, 1500.1, 1499.99, 1500.01]) / (EARTH_RADIUS_KM * 1000)
+    latitudes = np.concatenate([base_lat, base_lat + rng.normal(0, 0.008, n_base),
+                                base_lat[:4] + np.degrees(boundary), base_lat[4:8]])
+    longitudes = np.concatenate([base_lon, base_lon + rng.normal(0, 0.008, n_base), base_lon[:4], base_lon[4:8]])
+    longitudes = np.where(longitudes > 180, longitudes - 360, longitudes)
+    counts = rng.integers(0, 100, len(latitudes))
+    counts[n_base:2 * n_base:7] = counts[:n_base:7]  # Ties
+
+    rejected = duplicate_stations(latitudes, longitudes, counts, limit_km=1.5)
+    np.testing.assert_array_equal(rejected, duplicate_stations_loop(latitudes, longitudes, counts))